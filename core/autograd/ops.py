@@ -1,36 +1,71 @@
-from utils.helper import genname
-from utils.math import argsort
+from functools import lru_cache
+
+from core.autograd.profiler import profile
+from utils.math import argsort, prod
+
+@lru_cache(maxsize=None)
+def unbroadcast_axes(grad_shape, shape):
+    # leading axes and the size-1 axes that have been broadcasted
+    lead = len(grad_shape) - len(shape)
+    if lead < 0:
+        return ()
+    return (*range(lead), *(lead + i for i, s in enumerate(shape) if s == 1 and grad_shape[lead + i] != 1))
 
 def unbroadcast(func, shape):
     def wrapper(*args, **kwargs):
         ret = func(*args, **kwargs)
         if ret.shape == shape:
             return ret
-        ndim = len(shape)
-        for i in range(ret.ndim - ndim):
-            ret = ret.sum(axis=0)
-        for i in range(ndim):
-            if shape[i] == 1:
-                ret = ret.sum(axis=i, keepdims=True)
-        return ret
+        axes = unbroadcast_axes(tuple(ret.shape), tuple(shape))
+        if axes:
+            ret = ret.sum(axis=axes)
+        # NOTE: grad smaller than the tensor (e.g. the implicit scalar grad of backward()) is kept as it is
+        return ret.reshape(shape) if ret.shape != shape and prod(ret.shape) == prod(shape) else ret
     return wrapper
 
+class GradMode:
+    enabled = True
+
+class no_grad:
+    """Disable autograd bookkeeping, used as a context manager or a decorator (`@no_grad` or `@no_grad()`)"""
+    def __new__(cls, func=None):
+        # NOTE: the bare decorator passes the function, wrap it right away
+        self = super().__new__(cls)
+        return self if func is None else self(func)
+
+    def __enter__(self):
+        self.prev = GradMode.enabled
+        GradMode.enabled = False
+
+    def __exit__(self, *args):
+        GradMode.enabled = self.prev
+
+    def __call__(self, func):
+        def wrapper(*args, **kwargs):
+            with self.__class__():
+                return func(*args, **kwargs)
+        return wrapper
+
+inference_mode = no_grad
+
 def autograd_ops(func):
+    # NOTE: the leading `arr*` parameters are the tensor operands, resolve their count once
+    code = func.__code__
+    n_arrs = len([v for v in code.co_varnames[:code.co_argcount] if v.startswith("arr")])
     def wrapper(*args, **kwargs):
-        from core.tensor import Tensor
-        tss = [a for a in args if isinstance(a, Tensor)]
-        arr, *grad_fns = func(*[ts.array for ts in tss], *args[len(tss):], **kwargs)
-        grad_fns = [unbroadcast(grad_fn, ts.shape) for ts, grad_fn in zip(tss, grad_fns)]
-        requires_grad = False
-        for ts, grad_fn in zip(tss, grad_fns):
-            requires_grad = requires_grad or (ts.requires_grad and grad_fn)
-        dependency = []
-        for i, (ts, grad_fn) in enumerate(zip(tss, grad_fns)):
-            if ts.requires_grad and grad_fn:
-                ts.degree += 1
-                grad_fn.__name__ = f"grad_fn_{i+1} for {func.__name__}"
-                dependency.append(dict(tensor=ts, grad_fn=grad_fn))
-        return Tensor(arr, requires_grad, dependency, name=genname(func.__name__, *tss))
+        tss, args = args[:n_arrs], args[n_arrs:]
+        tensor_cls = tss[0].__class__
+        requires_grad = GradMode.enabled and any(ts.requires_grad for ts in tss)
+        if profile.current is not None:
+            arr, *grad_fns = profile.current.forward(func, requires_grad, *[ts.array for ts in tss], *args, **kwargs)
+        else:
+            arr, *grad_fns = func(*[ts.array for ts in tss], *args, **kwargs)
+        if not requires_grad:
+            # NOTE: drop the grad_fns right away so that they won't keep the input arrays alive
+            return tensor_cls(arr)
+        dependency = [dict(tensor=ts, grad_fn=grad_fn if ts.shape == arr.shape else unbroadcast(grad_fn, ts.shape))
+                      for ts, grad_fn in zip(tss, grad_fns) if ts.requires_grad and grad_fn]
+        return tensor_cls(arr, bool(dependency), dependency, name=(func.__name__, *map(id, tss)))
     return wrapper
 
 @autograd_ops
@@ -66,8 +101,8 @@ def pow(arr1, arr2):
 
 @autograd_ops
 def matmul(arr1, arr2):
-    grad_fn1 = lambda g: g @ arr2.T
-    grad_fn2 = lambda g: arr1.T @ g
+    grad_fn1 = lambda g: g.matmul(arr2, trans_b=True)
+    grad_fn2 = lambda g: arr1.matmul(g, trans_a=True)
     return arr1 @ arr2, grad_fn1, grad_fn2
 
 @autograd_ops
@@ -91,7 +126,8 @@ def sum(arr, axis=None, keepdims=False):
             assert not keepdims, "keepdims must be False when axis is None"
             return g.reshape([1] * arr.ndim).expand(shape)
         if not keepdims:
-            g = g.reshape((*shape[:axis], 1, *shape[axis+1:]))
+            axes = [a % arr.ndim for a in (axis if isinstance(axis, (tuple, list)) else (axis,))]
+            g = g.reshape([1 if i in axes else s for i, s in enumerate(shape)])
         return g.expand(shape)
     return result, grad_fn
 
@@ -102,11 +138,52 @@ def max(arr, axis=None, keepdims=False):
     return result, grad_fn
 
 @autograd_ops
-def min(arr, axis, keepdims):
+def min(arr, axis=None, keepdims=False):
     result = arr.min(axis=axis, keepdims=keepdims)
     grad_fn = lambda g: g * (result == arr)
     return result, grad_fn
 
+@autograd_ops
+def mean(arr, axis=None, keepdims=False):
+    result = arr.mean(axis=axis, keepdims=keepdims)
+    n = prod(arr.shape) // prod(result.shape)
+    def grad_fn(g):
+        shape = arr.shape
+        if not keepdims:
+            axes = range(arr.ndim) if axis is None else [a % arr.ndim for a in (axis if isinstance(axis, (tuple, list)) else (axis,))]
+            g = g.reshape([1 if i in axes else s for i, s in enumerate(shape)])
+        return g.expand(shape) / n
+    return result, grad_fn
+
+@autograd_ops
+def argmax(arr, axis=None, keepdims=False):
+    return arr.argmax(axis=axis, keepdims=keepdims), None
+
+@autograd_ops
+def softmax(arr):
+    result = arr.softmax()
+    grad_fn = lambda g: result * (g - (g * result).sum(axis=arr.ndim-1, keepdims=True))
+    return result, grad_fn
+
+@autograd_ops
+def log_softmax(arr):
+    result = arr.log_softmax()
+    grad_fn = lambda g: g - result.exp() * g.sum(axis=arr.ndim-1, keepdims=True)
+    return result, grad_fn
+
+@autograd_ops
+def softmax_cross_entropy(arr1, arr2):
+    # NOTE: softmax is recomputed in backward instead of being kept alive with the graph
+    expand = lambda g: g.reshape((*g.shape, 1))
+    grad_fn1 = lambda g: (arr1.softmax() - arr2) * expand(g)
+    grad_fn2 = lambda g: -arr1.log_softmax() * expand(g)
+    return arr1.softmax_cross_entropy(arr2), grad_fn1, grad_fn2
+
+@autograd_ops
+def sparse_softmax_cross_entropy(arr1, arr2):
+    grad_fn = lambda g: arr1.sparse_softmax_cross_entropy_grad(arr2, g)
+    return arr1.sparse_softmax_cross_entropy(arr2), grad_fn, None
+
 @autograd_ops
 def neg(arr):
     grad_fn = lambda g: -g
@@ -0,0 +1,129 @@
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from env import BACKEND, LAZY
+from utils.math import prod
+
+cl = None
+if BACKEND == "opencl":
+    from core.backend.opencl import cl
+
+CORE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def nbytes(arr):
+    return np.dtype(arr.dtype).itemsize * prod(arr.shape)
+
+def retained_arrays(fn, found):
+    # NOTE: arrays referenced by the closure of a grad_fn (and the helper closures it calls) stay alive with the graph
+    from core.backend.base import Array
+    for cell in fn.__closure__ or ():
+        try:
+            obj = cell.cell_contents
+        except ValueError:
+            continue
+        if isinstance(obj, Array):
+            found[id(obj)] = obj
+        elif callable(obj) and getattr(obj, "__closure__", None):
+            retained_arrays(obj, found)
+    return found
+
+class OpStat:
+    def __init__(self):
+        self.count = 0
+        self.fwd_time, self.bwd_time, self.device_time = 0.0, 0.0, 0.0
+        self.out_bytes, self.retained_bytes = 0, 0
+
+class profile:
+    """Record per autograd op call counts, forward/backward time and memory, used as a context manager
+    NOTE: in lazy mode the kernels run when the graph is evaluated, so only the graph building cost is recorded
+    """
+    current = None
+
+    def __init__(self, record_callsite=False):
+        self.record_callsite = record_callsite
+        self.stats, self.trace = {}, []
+        self.t0 = time.perf_counter()
+
+    def __enter__(self):
+        self.prev, profile.current = profile.current, self
+        # NOTE: the kernels launched within the profile run on a queue with profiling enabled
+        self.queue = cl.profiling() if cl is not None else None
+        if self.queue is not None: self.queue.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        if self.queue is not None: self.queue.__exit__(*args)
+        profile.current = self.prev
+
+    def _callsite(self):
+        # NOTE: skip the framework frames, including the Tensor methods generated by exec
+        frame = sys._getframe(3)
+        while frame is not None and frame.f_code.co_filename.startswith((CORE_DIR, "<string>")):
+            frame = frame.f_back
+        return "" if frame is None else f" ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})"
+
+    def _timeit(self, name, phase, fn, *args, **kwargs):
+        if cl is not None:
+            parent_events, cl.events = cl.events, []
+        ts = time.perf_counter()
+        ret = fn(*args, **kwargs)
+        device_time = 0.0
+        if cl is not None:
+            for e in cl.events:
+                e.wait()
+                device_time += (e.profile.end - e.profile.start) * 1e-9
+            if parent_events is not None:
+                parent_events.extend(cl.events)
+            cl.events = parent_events
+        cost = time.perf_counter() - ts
+        stat = self.stats.setdefault(name, OpStat())
+        stat.device_time += device_time
+        self.trace.append(dict(name=name, cat=phase, ph="X", pid=0, tid=0, ts=(ts - self.t0) * 1e6, dur=cost * 1e6,
+                               args=dict(device_ms=device_time * 1e3)))
+        return ret, cost, stat
+
+    def forward(self, func, requires_grad, *args, **kwargs):
+        name = func.__name__ + (self._callsite() if self.record_callsite else "")
+        (arr, *grad_fns), cost, stat = self._timeit(name, "forward", func, *args, **kwargs)
+        stat.count += 1
+        stat.fwd_time += cost
+        stat.out_bytes += nbytes(arr)
+        if not requires_grad:
+            return (arr, *grad_fns)
+        found = {}
+        for grad_fn in grad_fns:
+            if grad_fn: retained_arrays(grad_fn, found)
+        stat.retained_bytes += sum(nbytes(a) for a in found.values())
+        return (arr, *[self._backward(name, grad_fn) if grad_fn else grad_fn for grad_fn in grad_fns])
+
+    def _backward(self, name, grad_fn):
+        def wrapper(g):
+            ret, cost, stat = self._timeit(name, "backward", grad_fn, g)
+            stat.bwd_time += cost
+            return ret
+        return wrapper
+
+    def span(self, name, fn, *args, **kwargs):
+        return self._timeit(name, name, fn, *args, **kwargs)[0]
+
+    def table(self, sort_by="total"):
+        key = {"total": lambda s: s.fwd_time + s.bwd_time, "forward": lambda s: s.fwd_time,
+               "backward": lambda s: s.bwd_time, "device": lambda s: s.device_time,
+               "memory": lambda s: s.retained_bytes}[sort_by]
+        rows = sorted(((k, s) for k, s in self.stats.items() if s.count), key=lambda kv: -key(kv[1]))
+        width = max([len(k) for k, _ in rows] + [2])
+        lines = [f"{'op':<{width}} {'calls':>7} {'fwd(ms)':>10} {'bwd(ms)':>10} {'device(ms)':>11} "
+                 f"{'out(KB)':>10} {'retained(KB)':>13}"]
+        for k, s in rows:
+            lines.append(f"{k:<{width}} {s.count:>7} {s.fwd_time*1e3:>10.3f} {s.bwd_time*1e3:>10.3f} "
+                         f"{s.device_time*1e3:>11.3f} {s.out_bytes/1024:>10.1f} {s.retained_bytes/1024:>13.1f}")
+        if LAZY: lines.append("NOTE: lazy mode, kernels are not attributed to the ops")
+        return "\n".join(lines)
+
+    def export_chrome_trace(self, path):
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.trace, "displayTimeUnit": "ms"}, f)
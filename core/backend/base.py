@@ -4,7 +4,9 @@ from enum import Enum
 
 ElemwiseOps = Enum("ElemwiseOps",
     ["NEG", "EXP", "LOG", "ADD", "SUB", "DIV", "MUL", "POW", "EQ", "GE", "GT" , "NOOP", "RELU", "DRELU"])
-ReduceOps = Enum("ReduceOps", ["SUM", "MAX"])
+ReduceOps = Enum("ReduceOps", ["SUM", "MAX", "MIN", "MEAN", "ARGMAX"])
+SoftmaxOps = Enum("SoftmaxOps", ["SOFTMAX", "LOG_SOFTMAX", "SOFTMAX_CROSS_ENTROPY",
+                                 "SPARSE_SOFTMAX_CROSS_ENTROPY", "SPARSE_SOFTMAX_CROSS_ENTROPY_GRAD"])
 ProcessingOps = Enum("ProcessingOps", ["MATMUL", "CONV"])
 ViewOps = Enum("ViewOps", ["SLICE", "RESHAPE", "PERMUTE", "EXPAND"])
 CreationOps = Enum("CreationOps", ["EMPTY", "FULL", "UNIFORM", "NORMAL"])
@@ -71,6 +73,19 @@ class Array:
     # ##### Reduce Ops #####
     def sum(self, axis=None, keepdims=False): raise NotImplementedError
     def max(self, axis=None, keepdims=False): raise NotImplementedError
+    def min(self, axis=None, keepdims=False): raise NotImplementedError
+    def mean(self, axis=None, keepdims=False): raise NotImplementedError
+    def argmax(self, axis=None, keepdims=False): raise NotImplementedError
+
+    # ##### Processing Ops #####
+    def matmul(self, other, out=None, trans_a=False, trans_b=False): raise NotImplementedError
+
+    # ##### Softmax Ops (along the last axis) #####
+    def softmax(self): raise NotImplementedError
+    def log_softmax(self): raise NotImplementedError
+    def softmax_cross_entropy(self, labels): raise NotImplementedError
+    def sparse_softmax_cross_entropy(self, labels): raise NotImplementedError
+    def sparse_softmax_cross_entropy_grad(self, labels, grad): raise NotImplementedError
 
     # ##### View Ops #####
     def reshape(self, shape): raise NotImplementedError
@@ -1,52 +1,384 @@
+import weakref
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, reduce
+from types import SimpleNamespace
+
 import numpy as np
 
-from core.backend.base import Array
+from env import BACKEND, LAZY, NUM_THREADS, PARALLEL_THRESHOLD
+from core.backend.base import Array, ElemwiseOps
 from core.dtype import float32
+from core.jit.graph import GraphOptimizer, toposort
+from utils.math import prod
+
+# NOTE: the arrays of the numpy backend are lazy only when it is the main backend, on the opencl
+# backend they stay eager and serve as the reference cpu device
+LAZY = LAZY and BACKEND == "numpy"
+CHUNK_SIZE = 1 << 15  # elements of a fused elemwise chunk, the temporaries of a chunk stay in cache
+
+class Tape:
+    """Record NPArray ops as (fn, inputs, out) entries, replayed by calling fn(*inputs, out=out)"""
+    def __init__(self):
+        self.entries = None
+
+    @property
+    def recording(self):
+        return self.entries is not None
+
+    def start(self):
+        self.entries = []
+
+    def stop(self):
+        entries, self.entries = self.entries, None
+        return entries
+
+    def record(self, fn, inputs, out):
+        self.entries.append((fn, tuple(x.data for x in inputs), out.data))
+
+tape = Tape()
+
+class BufferOwner:
+    """Base of the arrays handed out for a pooled buffer, numpy keeps it alive as long as any view of them"""
+    def __init__(self, buf):
+        self.buf = buf
+        self.__array_interface__ = buf.__array_interface__
+
+class BufferPool:
+    """Recycle the buffers of large NPArrays by (nbytes, dtype) once the arrays and all their views are garbage"""
+    def __init__(self, min_bytes=1 << 16):
+        self.min_bytes = min_bytes
+        self.free = defaultdict(list)
+        self.info = {"hit": 0, "miss": 0, "bytes_in_use": 0, "bytes_held": 0, "peak_bytes": 0}
+
+    @property
+    def hit_rate(self):
+        return self.info["hit"] / max(self.info["hit"] + self.info["miss"], 1)
+
+    def empty(self, shape, dtype=float32):
+        """Return an uninitialized NPArray backed by a pooled buffer, or None if it is too small to be pooled"""
+        dtype = np.dtype(dtype)
+        nbytes = prod(shape) * dtype.itemsize
+        if nbytes < self.min_bytes:
+            return None
+        bufs = self.free.get((nbytes, dtype))
+        if bufs:
+            buf = bufs.pop()
+            self.info["hit"] += 1
+            self.info["bytes_held"] -= nbytes
+        else:
+            buf = np.empty(nbytes // dtype.itemsize, dtype=dtype)
+            self.info["miss"] += 1
+        self.info["bytes_in_use"] += nbytes
+        self.info["peak_bytes"] = max(self.info["peak_bytes"], self.info["bytes_in_use"] + self.info["bytes_held"])
+        # NOTE: every view of the array (e.g. a reshaped array or a captured graph) refers to the owner through its
+        # base chain, the buffer is released once the last of them dies
+        owner = BufferOwner(buf)
+        weakref.finalize(owner, self._release, buf)
+        return NPArray(np.asarray(owner).reshape(shape), dtype=dtype.type)
+
+    def _release(self, buf):
+        self.info["bytes_in_use"] -= buf.nbytes
+        self.free[(buf.nbytes, buf.dtype)].append(buf)
+        self.info["bytes_held"] += buf.nbytes
+
+    def trim(self):
+        """Drop the buffers held by the pool, e.g. between epochs"""
+        self.free.clear()
+        self.info["bytes_held"] = 0
+
+pool = BufferPool()
+
+def same_view(a, b):
+    return a.__array_interface__["data"][0] == b.__array_interface__["data"][0] and a.strides == b.strides
+
+class ChunkExecutor:
+    """Split large elemwise and reduce ops into contiguous chunks run by a thread pool, numpy releases
+    the GIL inside the ufunc loops so the chunks run in parallel"""
+    def __init__(self, num_threads=NUM_THREADS, threshold=PARALLEL_THRESHOLD, reduce_grain=1 << 16):
+        self.num_threads = num_threads
+        self.threshold = threshold  # elements of an op to run it in parallel
+        self.reduce_grain = reduce_grain  # elements of a partial reduction
+        self._threads = None
+
+    def parallel(self, shape):
+        return self.num_threads > 1 and prod(shape) >= self.threshold
+
+    @staticmethod
+    def split(n, parts):
+        bounds = [n * i // parts for i in range(parts + 1)]
+        return [slice(a, b) for a, b in zip(bounds, bounds[1:]) if a < b]
+
+    def map(self, fn, items):
+        if self._threads is None or self._threads._max_workers != self.num_threads:
+            if self._threads is not None: self._threads.shutdown()
+            self._threads = ThreadPoolExecutor(self.num_threads, thread_name_prefix="npchunk")
+        return list(self._threads.map(fn, items))
+
+    def elemwise(self, fn):
+        """Wrap an elemwise fn(*arrays, out=None) to fill the rows of out in parallel"""
+        def run(*arrays, out=None):
+            if out is None or out.ndim == 0 or out.shape[0] == 1:
+                return fn(*arrays, out=out)
+            arrays = [np.broadcast_to(a, out.shape) if a.ndim else a for a in arrays]
+            # NOTE: a chunk may read the elements another chunk has written when an input overlaps out with another
+            # layout (e.g. x += x.T), numpy handles the overlap of a single call
+            if any(a.ndim and not same_view(a, out) and np.shares_memory(a, out) for a in arrays):
+                return fn(*arrays, out=out)
+            def chunk(sl): fn(*[a[sl] if a.ndim else a for a in arrays], out=out[sl])
+            self.map(chunk, self.split(out.shape[0], self.num_threads))
+            return out
+        return run
+
+    def reduce(self, fn, combine, axis, keepdims):
+        """Wrap a numpy reduction fn(a, axis, keepdims, out) to reduce chunks of the input in parallel"""
+        def run(a, out=None):
+            axes = tuple(range(a.ndim)) if axis is None else tuple(ax % a.ndim for ax in np.atleast_1d(axis))
+            kept = [ax for ax in range(a.ndim) if ax not in axes and a.shape[ax] > 1]
+            # NOTE: prefer splitting a kept axis so that every chunk gives its own slice of the result, otherwise
+            # the chunks of a reduced axis give partial results combined in chunk order. The chunks only depend
+            # on the input size, the result does not change with the thread count
+            split = kept[0] if kept else next((ax for ax in axes if a.shape[ax] > 1), None)
+            if split is None:
+                return fn(a, axis=axis, keepdims=keepdims, out=out)
+            parts = self.num_threads if kept else -(-a.size // self.reduce_grain)
+            def chunk(sl): return fn(a[(slice(None),) * split + (sl,)], axis=axes, keepdims=True)
+            parts = self.map(chunk, self.split(a.shape[split], parts))
+            ret = np.concatenate(parts, axis=split) if kept else reduce(combine, parts)
+            if not keepdims: ret = ret.squeeze(axis=axes)
+            if out is None: return ret
+            out[...] = ret
+            return out
+        return run
+
+executor = ChunkExecutor()
+
+def _relu(a, out=None): return np.maximum(a, 0.0, out=out)
+def _drelu(a, b, out=None): return np.multiply(a, b > 0.0, out=out)
+
+def _argmax(a, axis, keepdims, out=None):
+    # NOTE: indices are returned as float32 like every other array of the framework
+    idx = np.argmax(a, axis=axis, keepdims=keepdims)
+    if out is None: return idx.astype(float32)
+    out[...] = idx
+    return out
+
+def _log_softmax(a, out=None):
+    out = np.subtract(a, a.max(axis=-1, keepdims=True), out=out)
+    out -= np.log(np.exp(out).sum(axis=-1, keepdims=True))
+    return out
+
+def _softmax(a, out=None):
+    out = np.subtract(a, a.max(axis=-1, keepdims=True), out=out)
+    np.exp(out, out=out)
+    out /= out.sum(axis=-1, keepdims=True)
+    return out
+
+def _softmax_cross_entropy(a, b, out=None):
+    return np.sum(b * -_log_softmax(a), axis=-1, out=out)
+
+def _sparse_labels(a, b):
+    # NOTE: out of range labels give nan rows like the opencl kernel, the gather reads a clamped label
+    bad = (b < 0) | (b >= a.shape[-1])
+    return np.arange(len(b)), np.clip(b, 0, a.shape[-1] - 1).astype(np.intp), bad
+
+def _sparse_softmax_cross_entropy(a, b, out=None):
+    rows, b, bad = _sparse_labels(a, b)
+    m = a.max(axis=-1, keepdims=True)
+    lse = m[:, 0] + np.log(np.exp(a - m).sum(axis=-1))
+    out = np.subtract(lse, a[rows, b], out=out)
+    out[bad] = np.nan
+    return out
+
+def _sparse_softmax_cross_entropy_grad(a, b, g, out=None):
+    rows, b, bad = _sparse_labels(a, b)
+    out = _softmax(a, out=out)
+    out[rows, b] -= 1.0
+    out *= g[:, None]
+    out[bad] = np.nan
+    return out
+
+ELEMWISE_MAPPING = {
+    ElemwiseOps.NOOP: "A", ElemwiseOps.NEG: "(-A)", ElemwiseOps.EXP: "np.exp(A)", ElemwiseOps.LOG: "np.log(A)",
+    ElemwiseOps.ADD: "A+B", ElemwiseOps.SUB: "A-B", ElemwiseOps.DIV: "A/B", ElemwiseOps.MUL: "A*B",
+    ElemwiseOps.POW: "np.power(A,B)", ElemwiseOps.EQ: "np.equal(A,B)", ElemwiseOps.GE: "np.greater_equal(A,B)",
+    ElemwiseOps.GT: "np.greater(A,B)", ElemwiseOps.RELU: "np.maximum(A,0.0)", ElemwiseOps.DRELU: "np.where(B>0.0,A,0.0)"
+}
+EAGER_OP_INFO = SimpleNamespace(operator=None, operands={}, args={})
+
+@lru_cache(maxsize=None)
+def compile_code(code):
+    return compile(code, "<elemwise>", "eval")
+
+def elemwise_op(op_info):
+    # NOTE: evaluate the whole (fused) expression chunk by chunk, so that the temporaries of every
+    # op stay in cache instead of materializing a full sized array per op
+    shape = op_info.args["shape"]
+    ret = pool.empty(shape) or NPArray(np.empty(shape, dtype=float32))
+    code = compile_code(op_info.code)
+    operands = {k: v.constant_value if v.constant_value is not None else v.data
+                for k, v in op_info.operands.items()}
+    size = prod(shape)
+    if size <= CHUNK_SIZE or not shape:
+        ret.data[...] = eval(code, {"np": np}, operands)
+        return ret
+    arrays = {k: np.broadcast_to(v, shape) for k, v in operands.items() if isinstance(v, np.ndarray) and v.size > 1}
+    if all(v.flags.c_contiguous for v in arrays.values()):
+        # same shaped contiguous operands, chunk over the flattened elements
+        out, arrays, step = ret.data.reshape(-1), {k: v.reshape(-1) for k, v in arrays.items()}, CHUNK_SIZE
+    else:
+        out, step = ret.data, max(1, CHUNK_SIZE * shape[0] // size)
+    starts = range(0, len(out), step)
+    def chunk(span):
+        local = dict(operands)
+        for i in starts[span]:
+            local.update({k: v[i:i+step] for k, v in arrays.items()})
+            out[i:i+step] = eval(code, {"np": np}, local)
+    if executor.parallel(shape):
+        executor.map(chunk, executor.split(len(starts), executor.num_threads))
+    else:
+        chunk(slice(None))
+    return ret
 
 class NPArray(Array):
     """Wrap numpy ndarray"""
-    def __init__(self, data, shape=None, dtype=float32):
-        super().__init__(shape, dtype)
-        self.data = np.asarray(data, dtype=dtype)
-        self.shape = self.data.shape
-        self.strides = tuple(s // dtype().itemsize for s in self.data.strides)
+    def __init__(self, data=None, shape=None, dtype=float32, op_info=None, is_lazy=False):
+        super().__init__(shape, dtype, op_info or EAGER_OP_INFO, is_lazy)
+        if not is_lazy:
+            if data.__class__ in (int, float):
+                self.constant_value = data
+            self.data = np.asarray(data, dtype=dtype)
+            self.shape = self.data.shape
 
     @property
-    def size(self): return self.data.nbytes
-    def numpy(self): return self.data.copy()
+    def strides(self):
+        if self.is_lazy: return tuple(prod(self.shape[i+1:]) for i in range(self.ndim))
+        return tuple(s // self.data.itemsize for s in self.data.strides)
+    @property
+    def c_contiguous(self): return self.is_lazy or self.data.flags.c_contiguous
+    @property
+    def f_contiguous(self): return (self.is_lazy and self.ndim <= 1) or (not self.is_lazy and self.data.flags.f_contiguous)
+    @property
+    def size(self): return np.dtype(self.dtype).itemsize * prod(self.shape) if self.is_lazy else self.data.nbytes
+    def numpy(self): return (self.eager() if self.is_lazy else self).data.copy()
+
+    def _compute(self, fn, *others, out=None, shape=None):
+        # NOTE: elemwise ops are the only lazy ops, the others evaluate their lazy inputs first
+        inputs = (self, *others)
+        if LAZY: inputs = tuple(x.eager() if x.is_lazy else x for x in inputs)
+        # NOTE: ops that know their result shape take the output buffer from the pool
+        if out is None and shape is not None:
+            out = pool.empty(shape)
+        if out is None:
+            out = NPArray(fn(*[x.data for x in inputs]))
+        else:
+            fn(*[x.data for x in inputs], out=out.data)
+        if tape.recording: tape.record(fn, inputs, out)
+        return out
+
+    def _elemwise(self, fn, op, *others, out=None):
+        if LAZY:
+            # NOTE: lazy nodes own their buffers, an op with an out is evaluated right away and copied into it
+            shape = np.broadcast_shapes(self.shape, *[x.shape for x in others])
+            op_info = SimpleNamespace(operator=op, code=ELEMWISE_MAPPING[op], operands=dict(zip("AB", (self, *others))),
+                                      args={"shape": shape, "dtype": float32})
+            ret = NPArray(shape=shape, dtype=float32, op_info=op_info, is_lazy=True)
+            if out is None:
+                return ret
+            if out.is_lazy: out.eager()
+            np.copyto(out.data, ret.eager().data)
+            return out
+        # NOTE: only results of large operands go through the pool, small ones are cheaper to allocate directly
+        if out is None and self.data.nbytes < pool.min_bytes and (not others or others[0].data.nbytes < pool.min_bytes):
+            return self._compute(fn, *others)
+        shape = self.shape if out is None else out.shape
+        if out is None and others and others[0].shape != shape:
+            shape = np.broadcast_shapes(shape, others[0].shape)
+        if executor.parallel(shape): fn = executor.elemwise(fn)
+        return self._compute(fn, *others, out=out, shape=shape)
+
+    def _view(self, fn):
+        if self.is_lazy: self.eager()
+        ret = NPArray(fn(self.data), dtype=self.dtype)
+        # NOTE: views of a recorded buffer stay valid on replay, only record the ops that copy
+        if tape.recording and not np.may_share_memory(ret.data, self.data):
+            tape.record(lambda a, out: np.copyto(out, fn(a)), (self,), ret)
+        return ret
 
     # ##### Elemwise Ops #####
-    def neg(self, out=None): return self.asarray(np.negative(self.data))
-    def exp(self, out=None): return self.asarray(np.exp(self.data))
-    def log(self, out=None): return self.asarray(np.log(self.data))
-    def add(self, other, out=None): return self.asarray(self.data + other.data)
-    def sub(self, other, out=None): return self.asarray(self.data - other.data)
-    def div(self, other, out=None): return self.asarray(self.data / other.data)
-    def mul(self, other, out=None): return self.asarray(self.data * other.data)
-    def pow(self, other, out=None): return self.asarray(self.data ** other.data)
-    def eq(self, other, out=None): return self.asarray(self.data == other.data)
-    def ge(self, other, out=None): return self.asarray(self.data >= other.data)
-    def gt(self, other, out=None): return self.asarray(self.data > other.data)
-    def matmul(self, other): return self.asarray(self.data @ other.data)
-    def relu(self, out=None): return self.asarray(np.maximum(self.data, 0.0))
-    def drelu(self, other, out=None): return self.asarray((other.data > 0.0) * self.data)
+    def neg(self, out=None): return self._elemwise(np.negative, ElemwiseOps.NEG, out=out)
+    def exp(self, out=None): return self._elemwise(np.exp, ElemwiseOps.EXP, out=out)
+    def log(self, out=None): return self._elemwise(np.log, ElemwiseOps.LOG, out=out)
+    def add(self, other, out=None): return self._elemwise(np.add, ElemwiseOps.ADD, other, out=out)
+    def sub(self, other, out=None): return self._elemwise(np.subtract, ElemwiseOps.SUB, other, out=out)
+    def div(self, other, out=None): return self._elemwise(np.divide, ElemwiseOps.DIV, other, out=out)
+    def mul(self, other, out=None): return self._elemwise(np.multiply, ElemwiseOps.MUL, other, out=out)
+    def pow(self, other, out=None): return self._elemwise(np.power, ElemwiseOps.POW, other, out=out)
+    def eq(self, other, out=None): return self._elemwise(np.equal, ElemwiseOps.EQ, other, out=out)
+    def ge(self, other, out=None): return self._elemwise(np.greater_equal, ElemwiseOps.GE, other, out=out)
+    def gt(self, other, out=None): return self._elemwise(np.greater, ElemwiseOps.GT, other, out=out)
+    def matmul(self, other, out=None, trans_a=False, trans_b=False):
+        # NOTE: the transposed views are handed to BLAS as they are, numpy passes them as transpose flags
+        fn = np.matmul
+        trans_a, trans_b = trans_a and self.ndim > 1, trans_b and other.ndim > 1
+        if trans_a or trans_b:
+            fn = lambda a, b, out=None: np.matmul(np.swapaxes(a, -1, -2) if trans_a else a,
+                                                  np.swapaxes(b, -1, -2) if trans_b else b, out=out)
+        shape = None
+        if out is None and self.ndim >= 2 and other.ndim >= 2 and (self.is_lazy or self.data.nbytes >= pool.min_bytes):
+            shape = (*np.broadcast_shapes(self.shape[:-2], other.shape[:-2]), self.shape[-1 if trans_a else -2],
+                     other.shape[-2 if trans_b else -1])
+        return self._compute(fn, other, out=out, shape=shape)
+    def relu(self, out=None): return self._elemwise(_relu, ElemwiseOps.RELU, out=out)
+    def drelu(self, other, out=None): return self._elemwise(_drelu, ElemwiseOps.DRELU, other, out=out)
 
     # ##### Reduce Ops #####
-    def sum(self, axis=None, keepdims=False): return self.asarray(np.sum(self.data, axis=axis, keepdims=keepdims))
-    def max(self, axis=None, keepdims=False): return self.asarray(np.max(self.data, axis=axis, keepdims=keepdims))
+    def sum(self, axis=None, keepdims=False, out=None): return self._reduce(np.sum, np.add, axis, keepdims, out)
+    def max(self, axis=None, keepdims=False, out=None): return self._reduce(np.max, np.maximum, axis, keepdims, out)
+    def min(self, axis=None, keepdims=False, out=None): return self._reduce(np.min, np.minimum, axis, keepdims, out)
+    def mean(self, axis=None, keepdims=False, out=None):
+        n = prod(self.shape[a] for a in (range(self.ndim) if axis is None else np.atleast_1d(axis)))
+        return self._reduce(np.sum, np.add, axis, keepdims, out, scale=float32(1.0 / n))
+    def argmax(self, axis=None, keepdims=False, out=None):
+        return self._compute(lambda a, out=None: _argmax(a, axis, keepdims, out=out), out=out)
+    def _reduce(self, fn, combine, axis, keepdims, out, scale=None):
+        if executor.parallel(self.shape):
+            run = executor.reduce(fn, combine, axis, keepdims)
+        else:
+            run = lambda a, out=None: fn(a, axis=axis, keepdims=keepdims, out=out)
+        if scale is not None:
+            unscaled = run
+            run = lambda a, out=None: np.multiply(unscaled(a, out=out), scale, out=out)
+        return self._compute(run, out=out)
+
+    # ##### Softmax Ops #####
+    def softmax(self): return self._compute(_softmax, shape=self.shape)
+    def log_softmax(self): return self._compute(_log_softmax, shape=self.shape)
+    def softmax_cross_entropy(self, labels): return self._compute(_softmax_cross_entropy, labels)
+    def sparse_softmax_cross_entropy(self, labels):
+        assert self.ndim == 2 and labels.shape == self.shape[:1], f"Invalid shapes {self.shape} {labels.shape}"
+        return self._compute(_sparse_softmax_cross_entropy, labels)
+    def sparse_softmax_cross_entropy_grad(self, labels, grad):
+        assert self.ndim == 2 and labels.shape == grad.shape == self.shape[:1], \
+                f"Invalid shapes {self.shape} {labels.shape} {grad.shape}"
+        return self._compute(_sparse_softmax_cross_entropy_grad, labels, grad, shape=self.shape)
 
     # ##### View Ops #####
-    def __getitem__(self, key): return self.asarray(self.data[key])
-    def __setitem__(self, key, value): self.data[key] = value.data
-    def reshape(self, shape): return self.asarray(np.reshape(self.data, shape))
-    def expand(self, shape): return self.asarray(np.broadcast_to(self.data, shape))
-    def squeeze(self, axis=None): return self.asarray(np.squeeze(self.data, axis))
-    def permute(self, axes): return self.asarray(np.transpose(self.data, axes))
+    def __getitem__(self, key): return self._view(lambda a: a[key])
+    def __setitem__(self, key, value):
+        if self.is_lazy: self.eager()
+        if value.is_lazy: value.eager()
+        self.data[key] = value.data
+        if tape.recording: tape.record(lambda v, out: out.__setitem__(key, v), (value,), self)
+    def reshape(self, shape): return self._view(lambda a: np.reshape(a, shape))
+    def expand(self, shape): return self._view(lambda a: np.broadcast_to(a, shape))
+    def squeeze(self, axis=None): return self._view(lambda a: np.squeeze(a, axis))
+    def permute(self, axes): return self._view(lambda a: np.transpose(a, axes))
 
     # ##### Creation Ops #####
     @classmethod
     def empty(cls, shape, dtype=float32):
-        return cls.asarray(np.empty(shape, dtype))
+        return pool.empty(shape, dtype) or cls(np.empty(shape, dtype), dtype=dtype)
     @classmethod
     def full(cls, shape, value, dtype=float32):
         return cls.asarray(np.full(shape, value, dtype))
@@ -56,3 +388,26 @@ class NPArray(Array):
     @classmethod
     def normal(cls, loc, scale, shape, dtype=float32):
         return cls.asarray(np.random.normal(loc, scale, shape).astype(dtype))
+
+    # ##### Lazy #####
+    def to_constant(self, value):
+        self.is_lazy = False
+        self.op_info = EAGER_OP_INFO
+        self.constant_value = value
+        self.data = np.full(self.shape, value, dtype=self.dtype)
+
+    def update_from_eager(self, eager):
+        self.data = eager.data
+        self.is_lazy = False
+        self.op_info = EAGER_OP_INFO
+        self.constant_value = eager.constant_value
+        return self
+
+    def eager(self):
+        if not self.is_lazy:
+            return self
+        GraphOptimizer(root=self).optimize()
+        for node in toposort(self, lazy_only=True):
+            if node.is_lazy:
+                node.update_from_eager(elemwise_op(node.op_info))
+        return self
@@ -1,4 +1,10 @@
 import copy
+import hashlib
+import json
+import os
+import re
+import struct
+from contextlib import contextmanager
 from types import SimpleNamespace
 from functools import lru_cache
 
@@ -7,9 +13,9 @@ import pyopencl
 import pyopencl.clrandom
 
 from env import *
-from core.backend.base import Array, ElemwiseOps, ProcessingOps, ReduceOps, ViewOps, CreationOps
+from core.backend.base import Array, ElemwiseOps, ProcessingOps, ReduceOps, SoftmaxOps, ViewOps, CreationOps
 from core.dtype import int32, float32
-from core.jit.graph import GraphOptimizer
+from core.jit.graph import GraphOptimizer, toposort
 from utils.math import prod
 from utils.helper import kernelstat
 
@@ -19,10 +25,88 @@ ELEMWISE_MAPPING = {
     ElemwiseOps.EQ: "(float)isequal(A,B)", ElemwiseOps.GE: "(float)isgreaterequal(A,B)", ElemwiseOps.GT: "(float)isgreater(A,B)",
     ElemwiseOps.RELU: "max(A,0.0f)", ElemwiseOps.DRELU: "B>0?A:0.0f"
 }
-REDUCE_AGG_FN = {ReduceOps.SUM: "A+B", ReduceOps.MAX: "max(A,B)"}
-REDUCE_PAD_VAL = {ReduceOps.SUM: "0.0f", ReduceOps.MAX: "-INFINITY"}
+REDUCE_AGG_FN = {ReduceOps.SUM: "A+B", ReduceOps.MAX: "max(A,B)", ReduceOps.MIN: "min(A,B)", ReduceOps.MEAN: "A+B"}
+REDUCE_PAD_VAL = {ReduceOps.SUM: "0.0f", ReduceOps.MAX: "-INFINITY", ReduceOps.MIN: "INFINITY", ReduceOps.MEAN: "0.0f",
+                  ReduceOps.ARGMAX: "-INFINITY"}
 
 
+class BinaryCache:
+    """Program binaries on disk keyed by the devices, driver versions and the kernel source,
+    the least recently used files are evicted once the total size is over max_bytes"""
+    def __init__(self, cache_dir=CL_CACHE_DIR, max_bytes=CL_CACHE_SIZE):
+        self.cache_dir, self.max_bytes = cache_dir, max_bytes
+
+    @property
+    def enabled(self):
+        return bool(self.cache_dir) and self.max_bytes > 0
+
+    def key(self, devices, program):
+        h = hashlib.sha256()
+        for d in devices:
+            h.update(f"{d.name}|{d.platform.version}|{d.driver_version}|".encode())
+        h.update(program.encode())
+        return h.hexdigest()
+
+    @staticmethod
+    def pack(binaries):
+        # NOTE: a count then a length before each binary, nothing in the file is executed when read
+        return struct.pack("<I", len(binaries)) + b"".join(struct.pack("<Q", len(b)) + bytes(b) for b in binaries)
+
+    @staticmethod
+    def unpack(data):
+        (count,), pos, binaries = struct.unpack_from("<I", data), 4, []
+        for _ in range(count):
+            (size,), pos = struct.unpack_from("<Q", data, pos), pos + 8
+            if pos + size > len(data): raise ValueError("truncated binary")
+            binaries.append(data[pos:pos + size])
+            pos += size
+        if pos != len(data): raise ValueError("trailing data")
+        return binaries
+
+    def get(self, key):
+        path = os.path.join(self.cache_dir, f"{key}.bin")
+        try:
+            with open(path, "rb") as f:
+                binaries = self.unpack(f.read())
+            os.utime(path)  # NOTE: mtime records the last use for the LRU eviction
+            return binaries
+        except (OSError, ValueError, struct.error):
+            return None
+
+    def put(self, key, binaries):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = os.path.join(self.cache_dir, f"{key}.bin")
+            # NOTE: write then rename, concurrent processes never read a partial file
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(self.pack(binaries))
+            os.replace(tmp, path)
+            self.evict()
+        except OSError:
+            pass
+
+    def evict(self):
+        entries = []
+        for e in os.scandir(self.cache_dir):
+            if e.name.endswith(".bin"):
+                st = e.stat()
+                entries.append((st.st_mtime, st.st_size, e.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        if os.path.isdir(self.cache_dir):
+            for e in os.scandir(self.cache_dir):
+                if e.name.endswith(".bin"): os.remove(e.path)
+
 class CLContext:
     def __init__(self):
         self.ctx, self.queue = None, None
@@ -31,19 +115,64 @@ class CLContext:
         if len(devices) == 0:
             devices = platform.get_devices(device_type=pyopencl.device_type.CPU)
         self.ctx = pyopencl.Context(devices)
-        self.queue = pyopencl.CommandQueue(self.ctx)
+        # NOTE: profiling costs every launch, it is only enabled with PROFILE=1 or within profiling()
+        self.queue = pyopencl.CommandQueue(self.ctx, properties=PROFILING_ENABLE if PROFILE else 0)
+        self._profiling_queue = None
+        self.events = None
         self.rng = pyopencl.clrandom.PhiloxGenerator(self.ctx, seed=0)
-        self.info = {"build_cnt": 0}
+        self.info = {"build_cnt": 0, "cache_hit": 0, "programs": {}}
+        self.cache = BinaryCache()
 
         alloc = pyopencl.tools.ImmediateAllocator(self.queue)
         self.mem_pool = pyopencl.tools.MemoryPool(alloc)
 
     @lru_cache(maxsize=None)
     def build(self, name, program):
-        self.info["build_cnt"] += 1
-        if DEBUG: print(f"[DEBUG] program {name}: \n {program}")
-        kernel = pyopencl.Program(self.ctx, program).build().__getattr__(name)
-        return lambda *args: kernel(self.queue, *args)
+        # NOTE: count the unique programs per kernel, compiled or loaded from the disk cache
+        self.info["programs"][name] = self.info["programs"].get(name, 0) + 1
+        kernel = self._load(program) if self.cache.enabled else None
+        if kernel is None:
+            self.info["build_cnt"] += 1
+            if DEBUG: print(f"[DEBUG] program {name}: \n {program}")
+            kernel = pyopencl.Program(self.ctx, program).build()
+            if self.cache.enabled:
+                self.cache.put(self.cache.key(self.ctx.devices, program), kernel.get_info(pyopencl.program_info.BINARIES))
+        kernel = kernel.__getattr__(name)
+        return lambda *args: self.record(kernel(self.queue, *args))
+
+    def _load(self, program):
+        binaries = self.cache.get(self.cache.key(self.ctx.devices, program))
+        if binaries is None:
+            return None
+        try:
+            kernel = pyopencl.Program(self.ctx, self.ctx.devices, binaries).build()
+        except pyopencl.Error:
+            return None  # NOTE: e.g. a stale binary of an updated driver, rebuild from the source
+        self.info["cache_hit"] += 1
+        return kernel
+
+    @contextmanager
+    def profiling(self):
+        """Run the launches of the block on a queue with profiling enabled, so that their events have timings"""
+        if self.queue.properties & PROFILING_ENABLE:
+            yield
+            return
+        if self._profiling_queue is None:
+            self._profiling_queue = pyopencl.CommandQueue(self.ctx, properties=PROFILING_ENABLE)
+        # NOTE: the queues are in order but not with each other, drain one before launching on the other
+        queue = self.queue
+        queue.finish()
+        self.queue = self._profiling_queue
+        try:
+            yield
+        finally:
+            self.queue.finish()
+            self.queue = queue
+
+    def record(self, event):
+        if self.events is not None:
+            self.events.append(event)
+        return event
 
     def alloc_local(self, size):
         return pyopencl.LocalMemory(size)
@@ -59,44 +188,195 @@ class CLContext:
     def enqueue(self, task, *args, **kwargs):
         getattr(pyopencl, f"enqueue_{task}")(self.queue, *args, **kwargs)
 
+PROFILING_ENABLE = pyopencl.command_queue_properties.PROFILING_ENABLE
 cl = CLContext()
 
-def elemwise_op(op_info):
-    inp = {k: v for k, v in op_info.operands.items() if v.constant_value is None}
-    const_inp = {k: v for k, v in op_info.operands.items() if v.constant_value is not None}
+class Autotuner:
+    """Pick the launch parameters of a kernel per (device, op, shape class) by timing the candidates with the
+    profiling events of the queue. The winners are saved to a json file reused by later runs, only the keys
+    missing from the file are tuned and only if enabled, otherwise the default of the op is used"""
+    def __init__(self, path=AUTOTUNE_FILE, enabled=AUTOTUNE, repeat=3):
+        self.path, self.enabled, self.repeat = path, enabled, repeat
+        device = cl.queue.device
+        self.device = f"{device.name}|{device.driver_version}"
+        self.results = self.load()
+        self._tuning = False
+        # NOTE: keyed by shape class so the memo stays small for any number of shapes, the params of an elemwise
+        # kernel are also cached per compiled kernel to skip the lookup on every launch
+        self._memo, self.kernel_params = {}, {}
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.results, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def shape_class(*dims):
+        # NOTE: power of 2 buckets, the best parameters change with the order of magnitude of a dim
+        return "x".join(str(int(d).bit_length()) for d in dims)
+
+    def choose(self, op, dims, candidates, default, bench):
+        """Return the parameter for the op, bench(candidate) launches the op once with the candidate"""
+        shape_class = self.shape_class(*dims)
+        memo_key = (op, shape_class)
+        if memo_key in self._memo:
+            return self._memo[memo_key]
+        key = f"{self.device}|{op}|{shape_class}"
+        if key in self.results:
+            self._memo[memo_key] = self.results[key]
+            return self.results[key]
+        # NOTE: the ops launched by a benchmarked op (e.g. the second pass of a reduce) are not tuned
+        if self._tuning:
+            return default
+        if not self.enabled or len(candidates) <= 1:
+            self._memo[memo_key] = default
+            return default
+        self._tuning = True
+        try:
+            times = {c: self.measure(bench, c) for c in candidates}
+        finally:
+            self._tuning = False
+        best = min(times, key=times.get)
+        if DEBUG: print(f"[DEBUG] autotune {key}: {best} {times}")
+        self.results[key] = self._memo[memo_key] = best
+        self.save()
+        return best
+
+    def measure(self, bench, candidate):
+        parent_events, parent_counter = cl.events, kernelstat._counter
+        try:
+            # NOTE: the benchmark launches are not recorded in the events and kernel stats of the caller
+            cl.events = []
+            kernelstat.reset()
+            bench(candidate)  # NOTE: warm up, builds the program
+            cl.events = []
+            with cl.profiling():
+                for _ in range(self.repeat):
+                    bench(candidate)
+            return sum((e.profile.end - e.profile.start) for e in cl.events) / self.repeat
+        except pyopencl.Error:
+            return float("inf")  # NOTE: e.g. out of resources for the local size
+        finally:
+            cl.events, kernelstat._counter = parent_events, parent_counter
+
+tuner = Autotuner()
+
+def scratch(op_info):
+    # NOTE: benchmark runs write into a new array, the out of an in-place op is also one of its inputs
+    return SimpleNamespace(**{**vars(op_info), "args": {**op_info.args, "out": None}})
+
+@lru_cache(maxsize=None)
+def canonical_code(code, names, prefix="x"):
+    """Rename the operands of an elemwise expression to x0, x1, ... by their first appearance in the code,
+    the kernel source then does not depend on the names given by the graph"""
+    if not names: return code, ()
+    pattern = re.compile(rf"\b({'|'.join(map(re.escape, names))})\b")
+    order = tuple(dict.fromkeys([*pattern.findall(code), *names]))
+    mapping = {n: f"{prefix}{i}" for i, n in enumerate(order)}
+    return pattern.sub(lambda m: mapping[m.group(1)], code), order
+
+@lru_cache(maxsize=4096)
+def coalesce_dims(shape, strides):
+    """Drop the dims of size 1 and merge the adjacent dims that every array walks contiguously, then pad the rank
+    to 2 or 4 with leading dims of size 1, the last array is the result. A kernel then only depends on the rank
+    bucket, e.g. a broadcast add compiles one program for every batch size including 1"""
+    dims = []
+    for i, d in enumerate(shape):
+        if d == 1: continue
+        ss = [s[i] for s in strides]
+        if dims and all(ps == s * d for ps, s in zip(dims[-1], ss)):
+            dims[-1] = ss
+        else:
+            dims.append(ss)
+    pad = (2 if len(dims) <= 2 else 4 if len(dims) <= 4 else len(dims)) - len(dims)
+    dims = [[0] * (len(strides) - 1) + [max(prod(shape), 1)]] * pad + dims
+    return tuple(tuple(ss[k] for ss in dims) for k in range(len(strides)))
+
+ELEMWISE_LOCAL_SIZES = [None] + [n for n in (32, 64, 128, 256) if n <= cl.queue.device.max_work_group_size]
+
+def elemwise_op(op_info, local_size=0):
+    code, order = canonical_code(op_info.code, tuple(op_info.operands))
+    operands = {f"x{i}": op_info.operands[n] for i, n in enumerate(order)}
+    inp = {k: v for k, v in operands.items() if v.constant_value is None}
+    const_inp = {k: v for k, v in operands.items() if v.constant_value is not None}
     shape, dtype = op_info.args["shape"], op_info.args["dtype"]
     ret = op_info.args["out"] if op_info.args.get("out", None) is not None else CLArray(shape=shape, dtype=dtype)
+    strides = tuple(x.strides for x in (*inp.values(), ret))
+    if all(x.ndim == ret.ndim for x in inp.values()):
+        strides = coalesce_dims(tuple(ret.shape), strides)
+    ndim = dict(zip([*inp, "res"], map(len, strides)))
     op = cl.build("ElemwiseOp", f"""
     __kernel void ElemwiseOp(
       // strides
-      {''.join(''.join(f'int {n}_s{i}, ' for i in range(arr.ndim)) for n, arr in inp.items())}
-      {''.join(f'int res_s{i}, ' for i in range(ret.ndim))}
+      {''.join(''.join(f'int {n}_s{i}, ' for i in range(ndim[n])) for n in inp)}
+      {''.join(f'int res_s{i}, ' for i in range(ndim["res"]))}
       // offset
       {''.join(f'int {n}_ofst, ' for n in inp)}
       // buffer inputs
       {''.join(f'__global const float *inp_{n}, ' for n in inp)}
       // constant inputs
       {''.join(f'const float {n}, ' for n in const_inp)}
-      __global float *ret
+      int size, __global float *ret
     ) {{
       {''.join(f'int {n}_i=0; ' for n in inp)}
       int idx=0, gl_id=get_global_id(0); int ptr=gl_id;
+      if (gl_id >= size) return;
       // calculate element indices
-      {''.join(f'idx=ptr/res_s{i}; ptr%=res_s{i}; ' + ''.join(f'{n}_i+=idx*{n}_s{i}; ' for n in inp if i < inp[n].ndim) for i in range(ret.ndim))}
+      {''.join(f'idx=ptr/res_s{i}; ptr%=res_s{i}; ' + ''.join(f'{n}_i+=idx*{n}_s{i}; ' for n in inp if i < ndim[n]) for i in range(ndim["res"]))}
       // get elements from input
       {''.join(f'float {n}=inp_{n}[{n}_i+{n}_ofst]; ' for n in inp)}
-      ret[gl_id] = {op_info.code};
+      ret[gl_id] = {code};
     }}
     """)
-    args = [int32(s) for x in list(inp.values()) + [ret] for s in x.strides]
+    args = [int32(s) for ss in strides for s in ss]
     args += [int32(x.offset) for x in inp.values()]
     args += [x.buffer for x in inp.values()]
     args += [float32(x.constant_value) for x in const_inp.values()]
-    e = op((prod(shape),), None, *args, ret.buffer)
+    size = prod(shape)
+    if local_size == 0:
+        params_key = (op, size.bit_length())
+        local_size = tuner.kernel_params.get(params_key, 0)
+        if local_size == 0:
+            local_size = tuner.choose("elemwise_op", (size, ndim["res"]), ELEMWISE_LOCAL_SIZES, None,
+                                      lambda n: elemwise_op(scratch(op_info), local_size=n))
+            if not tuner._tuning: tuner.kernel_params[params_key] = local_size
+    global_size = size if local_size is None else (size + local_size - 1) // local_size * local_size
+    e = op((global_size,), None if local_size is None else (local_size,), *args, int32(size), ret.buffer)
     kernelstat.log(op_info.operator)
     return ret
 
-def matmul_op(op_info):
+# NOTE: C tile TSxTS per work group, K step TSK, a WPTxWPT block of C per work item
+MATMUL_CONFIGS = {
+    "8x8w1": {"TS": 8, "TSK": 8, "WPT": 1},
+    "16x16w2": {"TS": 16, "TSK": 16, "WPT": 2},
+    "32x16w4": {"TS": 32, "TSK": 16, "WPT": 4},
+    "64x16w8": {"TS": 64, "TSK": 16, "WPT": 8},
+    "32x16w8": {"TS": 32, "TSK": 16, "WPT": 8},
+}
+
+def matmul_config(M, N, K):
+    # NOTE: a cpu device runs the work items of a group as a loop, few work items with large register blocks
+    # are the fastest for every shape. A gpu needs enough work items per group to hide the memory latency,
+    # larger tiles reuse more of the loaded data but pad more on small matrices
+    if cl.queue.device.type & pyopencl.device_type.CPU: return "32x16w8"
+    if min(M, N) >= 256: return "64x16w8"
+    if max(M, N) >= 64: return "32x16w4"
+    if max(M, N) >= 16: return "16x16w2"
+    return "8x8w1"
+
+def matmul_op(op_info, config=None):
     # rule: https://numpy.org/doc/stable/reference/generated/numpy.matmul.html
     a, b = op_info.operands.values()
     ret_shape = op_info.ret_shape
@@ -105,12 +385,21 @@ def matmul_op(op_info):
         assert ret.c_contiguous and ret.shape == ret_shape
     else:
         ret = CLArray(shape=ret_shape, dtype=a.dtype)
-    BS, M, K, N = prod(a.shape[:-2]), a.shape[-2], a.shape[-1], b.shape[-1]
-    gs = 1
-    while gs <= 8 and M % gs == 0 and N % gs == 0 and K % gs == 0 and gs <= K and gs <= M and gs <= N:
-        gs *= 2
-    gs //= 2
-    if DEBUG: print(f"[DEBUG] BS:{BS} M:{M} K:{K} N:{N} grp_size:{gs}")
+    # NOTE: a transposed operand is read through its swapped strides instead of a permuted copy
+    trans_a, trans_b = op_info.args.get("trans_a", False), op_info.args.get("trans_b", False)
+    a_strides = (a.strides[0], a.strides[2], a.strides[1]) if trans_a else a.strides
+    b_strides = (b.strides[0], b.strides[2], b.strides[1]) if trans_b else b.strides
+    BS, M, K, N = prod(a.shape[:-2]), a.shape[-1 if trans_a else -2], a.shape[-2 if trans_a else -1], b.shape[-2 if trans_b else -1]
+    if config is None:
+        config = tuner.choose("matmul_op", (BS, M, N, K), list(MATMUL_CONFIGS), matmul_config(M, N, K),
+                              lambda c: matmul_op(scratch(op_info), config=c))
+    cfg = MATMUL_CONFIGS[config]
+    TS, TSK, WPT = cfg["TS"], cfg["TSK"], cfg["WPT"]
+    RTS = TS // WPT
+    # NOTE: float4 loads along k for A and along n for B, needs unit inner strides and K/N multiples of 4 so that
+    # a vector is either fully inside or fully outside the matrix
+    vec = a_strides[2] == 1 and b_strides[2] == 1 and K % 4 == 0 and N % 4 == 0
+    if DEBUG: print(f"[DEBUG] BS:{BS} M:{M} K:{K} N:{N} tile:{TS}x{TS}x{TSK} wpt:{WPT} vec:{vec}")
 
     # extra post compute
     # TODO: refactor extra
@@ -124,6 +413,24 @@ def matmul_op(op_info):
         extra_strides = ''.join(''.join(f'int {n}_s{i}, ' for i in range(arr.ndim)) for n, arr in extra_inp.items()) + ''.join(f'int res_s{i}, ' for i in range(ret.ndim))
         extra_gl2lc = ''.join(f'idx=ptr/res_s{i}; ptr%=res_s{i}; ' + ''.join(f'{n}_i+=idx*{n}_s{i}; ' for n, arr in extra_inp.items() if i < arr.ndim) for i in range(ret.ndim))
 
+    if vec:
+        load_tiles = f"""
+        for (int l=tid; l<{TS*TSK//4}; l+={RTS*RTS}) {{
+          int r=l/{TSK//4}, k=l%{TSK//4}*4;
+          float4 v = m0+r<M && t+k<K ? vload4(0, A + bs*A_s0 + (m0+r)*A_s1 + t+k + a_ofst) : (float4)(0.0f);
+          Asub[k][r]=v.x; Asub[k+1][r]=v.y; Asub[k+2][r]=v.z; Asub[k+3][r]=v.w;
+          int kk=l/{TS//4}, c=l%{TS//4}*4;
+          float4 w = t+kk<K && n0+c<N ? vload4(0, B + bs*B_s0 + (t+kk)*B_s1 + n0+c + b_ofst) : (float4)(0.0f);
+          vstore4(w, 0, &Bsub[kk][c]);
+        }}"""
+    else:
+        load_tiles = f"""
+        for (int l=tid; l<{TS*TSK}; l+={RTS*RTS}) {{
+          int r=l/{TSK}, k=l%{TSK};
+          Asub[k][r] = m0+r<M && t+k<K ? A[bs*A_s0 + (m0+r)*A_s1 + (t+k)*A_s2 + a_ofst] : 0.0f;
+          int kk=l/{TS}, c=l%{TS};
+          Bsub[kk][c] = t+kk<K && n0+c<N ? B[bs*B_s0 + (t+kk)*B_s1 + (n0+c)*B_s2 + b_ofst] : 0.0f;
+        }}"""
     op = cl.build("matmul_op", f"""
     __kernel void matmul_op(
       int BS, int M, int N, int K,
@@ -134,100 +441,241 @@ def matmul_op(op_info):
       {''.join(f'const float {n}, ' for n in extra_const_inp)}
       __global const float *A, __global const float *B, __global float *C
     ) {{
-      int bs=get_global_id(0), m=get_global_id(1), n=get_global_id(2), i=get_local_id(1), j=get_local_id(2);
-      __local float Alcl[{gs}][{gs}], Blcl[{gs}][{gs}];
-      float acc = 0.0f;
-      for (int t=0; t<K/{gs}; t++) {{
-        Alcl[i][j] = A[bs*A_s0 + m*A_s1 + (t*{gs}+j)*A_s2 + a_ofst];
-        Blcl[i][j] = B[bs*B_s0 + (t*{gs}+i)*B_s1 + n*B_s2 + b_ofst];
+      // NOTE: a work group computes a {TS}x{TS} tile of C, every work item a {WPT}x{WPT} block held in registers.
+      // The rows/cols of a block are {RTS} apart so that neighbouring work items touch neighbouring elements
+      int bs=get_global_id(0), i=get_local_id(1), j=get_local_id(2), tid=i*{RTS}+j;
+      int m0=get_group_id(1)*{TS}, n0=get_group_id(2)*{TS};
+      __local float Asub[{TSK}][{TS}], Bsub[{TSK}][{TS}];
+      float accs[{WPT}][{WPT}], breg[{WPT}];
+      for (int r=0; r<{WPT}; r++) for (int c=0; c<{WPT}; c++) accs[r][c] = 0.0f;
+      for (int t=0; t<K; t+={TSK}) {{
+        {load_tiles}
         barrier(CLK_LOCAL_MEM_FENCE);
-        for (int k=0; k<{gs}; k++) acc += Alcl[i][k] * Blcl[k][j];
+        for (int k=0; k<{TSK}; k++) {{
+          for (int c=0; c<{WPT}; c++) breg[c] = Bsub[k][j+c*{RTS}];
+          for (int r=0; r<{WPT}; r++) {{
+            float areg = Asub[k][i+r*{RTS}];
+            for (int c=0; c<{WPT}; c++) accs[r][c] += areg * breg[c];
+          }}
+        }}
         barrier(CLK_LOCAL_MEM_FENCE);
       }}
-      // C[bs*M*N+m*N+n] = acc;
-      // NOTE: handle non-contiguous extra_inp
-      int k = bs*M*N+m*N+n, ptr=k, idx=0;
-      {''.join(f'int {n}_i=0; ' for n in extra_inp)}
-      {extra_gl2lc}
-      {''.join(f'float {n}=inp_{n}[{n}_i]; ' for n in extra_inp)}
-      C[k] = {extra_code};
+      for (int r=0; r<{WPT}; r++) for (int c=0; c<{WPT}; c++) {{
+        int m=m0+i+r*{RTS}, n=n0+j+c*{RTS};
+        if (m >= M || n >= N) continue;
+        float acc = accs[r][c];
+        // NOTE: handle non-contiguous extra_inp
+        int k = bs*M*N+m*N+n, ptr=k, idx=0;
+        {''.join(f'int {n}_i=0; ' for n in extra_inp)}
+        {extra_gl2lc}
+        {''.join(f'float {n}=inp_{n}[{n}_i]; ' for n in extra_inp)}
+        C[k] = {extra_code};
+      }}
     }}""")
-    strides = [s for ss in zip(a.strides, b.strides) for s in ss]
+    strides = [s for ss in zip(a_strides, b_strides) for s in ss]
     args = [int32(x) for x in [BS, M, N, K] + strides + [a.offset, b.offset]]
     if extra_inp:
         args += [int32(s) for x in list(extra_inp.values()) + [ret] for s in x.strides]
     args += [x.buffer for x in extra_inp.values()]
     args += [float32(x.constant_value) for x in extra_const_inp.values()]
-    e = op((BS, M, N), (1, gs, gs), *args, a.buffer, b.buffer, ret.buffer)
+    e = op((BS, (M + TS - 1) // TS * RTS, (N + TS - 1) // TS * RTS), (1, RTS, RTS), *args, a.buffer, b.buffer, ret.buffer)
     kernelstat.log(op_info.operator)
     return ret
 
-def reduce_op(op_info):
-    x = next(iter(op_info.operands.values()))
-    x_shp = x.shape
-    axis, keepdims = op_info.args["axis"], op_info.args["keepdims"]
-    if axis is None: axis, x_shp = 0, (prod(x.shape),)
-    size = x_shp[axis]
-
-    grp_size = 2
-    max_work_group_size = cl.queue.device.max_work_group_size
-    while grp_size != max_work_group_size and grp_size < size:
-        grp_size *= 2
-
-    def calculate_ret_shape(x_shp, axis, keepdims, grp_size, n_grps):
-        if n_grps <= 1:
-            ret_shape = [d for i, d in enumerate(x_shp) if i != axis]
-            if keepdims: ret_shape.insert(axis, 1)
-            return tuple(ret_shape)
-        return tuple(n_grps if i == axis else d for i, d in enumerate(x_shp))
-
-    n_grps = (size + grp_size - 1) // grp_size
-    ret_shape = calculate_ret_shape(x_shp, axis, keepdims, grp_size, n_grps)
-    # NOTE: for array with constant_value, return a new array filled with the value directly
-    if x.constant_value is not None:
-        return CLArray.full(ret_shape, x.constant_value, x.dtype)
+def reduce_dims(shape, strides, dims):
+    """Coalesce the given dims of the arrays, returns the strides to decompose a flat index over the dims
+    and the strides of every array for them"""
+    shape = tuple(shape[i] for i in dims)
+    contiguous = tuple(prod(shape[i+1:]) for i in range(len(shape)))
+    *x_strides, strides = coalesce_dims(shape, (*(tuple(s[i] for i in dims) for s in strides), contiguous))
+    return strides, x_strides
+
+def reduce_op(op_info, grp_size=None):
+    # NOTE: a work group reduces a chunk of the reduced elements of one output, all dims (kept, reduced) are walked
+    # by strides so any view is reduced in place. Several chunks per output (n_chunks > 1) write partial results
+    # reduced by a second launch. A fused elemwise expression of the operands (op_info.code) is computed on load,
+    # a fused elemwise epilogue (args["extra"], the result named acc) on store
+    code, order = canonical_code(getattr(op_info, "code", next(iter(op_info.operands))), tuple(op_info.operands))
+    operands = {f"x{i}": op_info.operands[n] for i, n in enumerate(order)}
+    extra = op_info.args.get("extra", {})
+    extra_code, extra_order = canonical_code(extra.get("code", "acc"), tuple(extra.get("operands", {})), prefix="e")
+    epilogue = (extra_code, {f"e{i}": extra["operands"][n] for i, n in enumerate(extra_order)})
+    op, axes, ret_shape = op_info.operator, op_info.args["axis"], op_info.args["shape"]
+    shape = operands["x0"].shape
+    kept = tuple(i for i in range(len(shape)) if i not in axes)
+    n_red, n_out = prod(shape[i] for i in axes), prod(shape[i] for i in kept)
+    # NOTE: for array with constant_value, return a new array filled with the result directly
+    x = operands["x0"]
+    if code == "x0" and x.constant_value is not None and not epilogue[1] and extra_code == "acc":
+        value = {ReduceOps.SUM: x.constant_value * n_red, ReduceOps.ARGMAX: 0.0}.get(op, x.constant_value)
+        return CLArray.full(ret_shape, value, x.dtype)
     ret = CLArray(shape=ret_shape, dtype=x.dtype)
+    if grp_size is None:
+        np2 = 1 << max(n_red - 1, 0).bit_length()
+        max_grp = min(cl.queue.device.max_work_group_size, 1024)
+        # NOTE: the group reduces up to 256 elements as a tree, the pairwise sums keep the rounding error low
+        default = min(np2, 256, max_grp)
+        candidates = [g for g in (1, 4, 16, 64, 256, 1024) if g <= min(np2, max_grp)]
+        grp_size = tuner.choose("reduce_op", (n_out, n_red), candidates, default,
+                                lambda g: reduce_op(op_info, grp_size=g))
+    # NOTE: split the reduction of an output into chunks only when there are too few outputs to fill the device
+    n_chunks = 1 if n_out >= 64 else min(grp_size, max(1, n_red // (grp_size * 8)))
+    if n_chunks == 1:
+        reduce_launch(op, code, operands, kept, axes, n_chunks, grp_size, ret, n_red, epilogue=epilogue)
+    else:
+        partial = CLArray(shape=(n_out, n_chunks), dtype=x.dtype)
+        partial_idx = CLArray(shape=(n_out, n_chunks), dtype=x.dtype) if op == ReduceOps.ARGMAX else None
+        reduce_launch(op, code, operands, kept, axes, n_chunks, grp_size, partial, n_red, ret_idx=partial_idx)
+        reduce_launch(op, "x0", {"x0": partial}, (0,), (1,), 1, min(grp_size, 1 << (n_chunks - 1).bit_length()),
+                      ret, n_red, inp_idx=partial_idx, epilogue=epilogue)
+    kernelstat.log(op)
+    return ret
 
-    # merge non-target axes
-    p1 = [prod(x_shp[:axis])] if axis!=0 else []
-    p2 = [prod(x_shp[axis+1:])] if axis!=len(x_shp)-1 else []
-    global_size = (*p1, grp_size*n_grps, *p2)
-    axis, ndim = len(p1), len(global_size)
-
-    a = [f"gl_id_{i}" for i in range(ndim)]
-    b = [f"gl_s_{i}" for i in range(ndim)]
-    c = ["*".join(b[i+1:]) for i in range(ndim-1)] + ["1"]
-    gl2lcl = "+".join([f"{a_}*{c_}" for a_, c_ in zip(a, c)])
-    a = [(f"grp_id_{i}" if i == axis else f"gl_id_{i}") for i in range(ndim)]
-    b = [f"(gl_s_{i}/grp_s_{i})" for i in range(ndim)]
-    c = ["*".join(b[i+1:]) for i in range(ndim-1)] + ["1"]
-    lcl2gl = "+".join([f"{a_}*{c_}" for a_, c_ in zip(a, c)])
-    # NOTE: calculate offset to get the proper global index
-    offset = f"gl_id_0*{'0' if axis==0 else '1' if axis==ndim-1 else 'gl_s_2'}*(gl_s_{axis}-size)"
-    op = cl.build("reduce_op", f"""
+def reduce_launch(op, code, operands, kept, axes, n_chunks, grp_size, ret, total, inp_idx=None, ret_idx=None,
+                  epilogue=("acc", {})):
+    inp = {k: v for k, v in operands.items() if v.constant_value is None}
+    const_inp = {k: v for k, v in operands.items() if v.constant_value is not None}
+    shape = operands["x0"].shape
+    n_red, n_out = prod(shape[i] for i in axes), prod(shape[i] for i in kept)
+    out_s, x_out_s = reduce_dims(shape, [x.strides for x in inp.values()], kept)
+    red_s, x_red_s = reduce_dims(shape, [x.strides for x in inp.values()], axes)
+    extra_code, extra = epilogue
+    extra_inp = {k: v for k, v in extra.items() if v.constant_value is None}
+    extra_const_inp = {k: v for k, v in extra.items() if v.constant_value is not None}
+    ret_s, extra_s = reduce_dims(ret.shape, [x.strides for x in extra_inp.values()], range(ret.ndim))
+    # NOTE: argmax carries the index of the value, the first one wins a tie like numpy
+    argmax = op == ReduceOps.ARGMAX
+    if argmax:
+        agg = "if (B > A || (B == A && b_i < a_i)) { A = B; a_i = b_i; }"
+        index = "(int)inp_idx[x0_a]" if inp_idx is not None else "r"
+    else:
+        agg, index = f"A = {REDUCE_AGG_FN[op]};", "r"
+    if n_chunks > 1:
+        store = "ret[o*n_chunks+p] = A;" + (" ret_idx[o*n_chunks+p] = (float)a_i;" if argmax else "")
+    else:
+        acc = {ReduceOps.MEAN: "A / (float)total", ReduceOps.ARGMAX: "(float)a_i"}.get(op, "A")
+        store = (f"ptr=o; {''.join(f'int {n}_a={n}_ofst; ' for n in extra_inp)}"
+                 + "".join(f"idx=ptr/ret_s{i}; ptr%=ret_s{i}; " + "".join(f"{n}_a+=idx*{n}_s{i}; " for n in extra_inp)
+                           for i in range(len(ret_s)))
+                 + "".join(f"float {n}=inp_{n}[{n}_a]; " for n in extra_inp)
+                 + f"float acc = {acc}; ret[o] = {extra_code};")
+    def decompose(var, dims, prefix, base):
+        return f"ptr={var}; " + "".join(f"idx=ptr/{prefix}_s{i}; ptr%={prefix}_s{i}; " + "".join(
+            f"{n}_{base}+=idx*{n}_{prefix}s{i}; " for n in inp) for i in range(dims))
+    prg = cl.build("reduce_op", f"""
     __kernel void reduce_op(
-      int size, int ofst, __global const float *inp, __local float *lcl, __global float *ret
+      int n_red, int chunk, int total,
+      {''.join(f'int o_s{i}, ' for i in range(len(out_s)))}{''.join(f'int {n}_os{i}, ' for n in inp for i in range(len(out_s)))}
+      {''.join(f'int r_s{i}, ' for i in range(len(red_s)))}{''.join(f'int {n}_rs{i}, ' for n in inp for i in range(len(red_s)))}
+      {''.join(f'int ret_s{i}, ' for i in range(len(ret_s)))}{''.join(f'int {n}_s{i}, ' for n in extra_inp for i in range(len(ret_s)))}
+      {''.join(f'int {n}_ofst, __global const float *inp_{n}, ' for n in (*inp, *extra_inp))}
+      {''.join(f'const float {n}, ' for n in (*const_inp, *extra_const_inp))}
+      {'__global const float *inp_idx, ' if inp_idx is not None else ''}
+      __local float *lcl, __local int *lcl_i, __global float *ret{', __global float *ret_idx' if ret_idx is not None else ''}
     ) {{
-      {''.join([f'int gl_id_{i}=get_global_id({i});int gl_s_{i}=get_global_size({i});int grp_id_{i}=get_group_id({i});int grp_s_{i}=get_local_size({i});' for i in range(ndim)])}
-      int lcl_id = get_local_id({axis});
-      lcl[lcl_id] = gl_id_{axis} < size ? inp[{gl2lcl}-{offset}+ofst] : {REDUCE_PAD_VAL[op_info.operator]};
+      int o=get_group_id(0), p=get_group_id(1), n_chunks=get_num_groups(1), lid=get_local_id(0), grp_s=get_local_size(0);
+      int idx, ptr;
+      {''.join(f'int {n}_b={n}_ofst; ' for n in inp)}
+      {decompose("o", len(out_s), "o", "b")}
+      float A = {REDUCE_PAD_VAL[op]}, B; int a_i = n_red, b_i;
+      int stop = min((p+1)*chunk, n_red);
+      for (int r=p*chunk+lid; r<stop; r+=grp_s) {{
+        {''.join(f'int {n}_a={n}_b; ' for n in inp)}
+        {decompose("r", len(red_s), "r", "a")}
+        {''.join(f'float {n}=inp_{n}[{n}_a]; ' for n in inp)}
+        B = {code}; b_i = {index};
+        {agg}
+      }}
+      lcl[lid] = A; lcl_i[lid] = a_i;
       barrier(CLK_LOCAL_MEM_FENCE);
-      for (int stride = grp_s_{axis}>>1; stride > 0; stride>>=1) {{
-        float A = lcl[lcl_id], B = lcl[lcl_id+stride];
-        if (lcl_id<stride) lcl[lcl_id] = {REDUCE_AGG_FN[op_info.operator]};
+      for (int stride=grp_s>>1; stride>0; stride>>=1) {{
+        if (lid < stride) {{
+          A = lcl[lid]; a_i = lcl_i[lid]; B = lcl[lid+stride]; b_i = lcl_i[lid+stride];
+          {agg}
+          lcl[lid] = A; lcl_i[lid] = a_i;
+        }}
         barrier(CLK_LOCAL_MEM_FENCE);
       }}
-      if (lcl_id == 0) ret[{lcl2gl}] = lcl[0];
+      if (lid == 0) {{ A = lcl[0]; a_i = lcl_i[0]; {store} }}
     }}
     """)
+    args = [int32(n_red), int32((n_red + n_chunks - 1) // n_chunks), int32(total)]
+    for s, xs in ((out_s, x_out_s), (red_s, x_red_s), (ret_s, extra_s)):
+        args += [int32(v) for v in s] + [int32(v) for ss in xs for v in ss]
+    args += [a for x in (*inp.values(), *extra_inp.values()) for a in (int32(x.offset), x.buffer)]
+    args += [float32(x.constant_value) for x in (*const_inp.values(), *extra_const_inp.values())]
+    args += [inp_idx.buffer] if inp_idx is not None else []
+    args += [cl.alloc_local(4 * grp_size), cl.alloc_local(4 * grp_size), ret.buffer]
+    args += [ret_idx.buffer] if ret_idx is not None else []
+    prg((n_out * grp_size, n_chunks), (grp_size, 1), *args)
+
+def softmax_op(op_info):
+    # NOTE: one work group per row, reduce max and sum of exp in local memory then write the epilogue
+    x, *rest = [CLArray.full(v.shape, v.constant_value, v.dtype) if v.constant_value is not None else v
+                for v in op_info.operands.values()]
+    C, xent = x.shape[-1], op_info.operator == SoftmaxOps.SOFTMAX_CROSS_ENTROPY
+    sparse = op_info.operator in (SoftmaxOps.SPARSE_SOFTMAX_CROSS_ENTROPY, SoftmaxOps.SPARSE_SOFTMAX_CROSS_ENTROPY_GRAD)
+    ret_shape = x.shape[:-1] if op_info.operator in (SoftmaxOps.SOFTMAX_CROSS_ENTROPY, SoftmaxOps.SPARSE_SOFTMAX_CROSS_ENTROPY) else x.shape
+    ret = CLArray(shape=ret_shape, dtype=x.dtype)
+    grp_size = 1
+    while grp_size < C and grp_size < cl.queue.device.max_work_group_size:
+        grp_size *= 2
+
+    def block_reduce(agg):
+        return f"""
+      lcl[lcl_id] = acc;
+      barrier(CLK_LOCAL_MEM_FENCE);
+      for (int stride=grp_s>>1; stride>0; stride>>=1) {{
+        if (lcl_id<stride) {{ float A=lcl[lcl_id], B=lcl[lcl_id+stride]; lcl[lcl_id]={agg}; }}
+        barrier(CLK_LOCAL_MEM_FENCE);
+      }}
+      acc = lcl[0];
+      barrier(CLK_LOCAL_MEM_FENCE);"""
+
+    epilogue = {
+        SoftmaxOps.SOFTMAX: "for (int i=lcl_id; i<C; i+=grp_s) ret[row*C+i] = exp(x[i]-lse);",
+        SoftmaxOps.LOG_SOFTMAX: "for (int i=lcl_id; i<C; i+=grp_s) ret[row*C+i] = x[i]-lse;",
+        SoftmaxOps.SOFTMAX_CROSS_ENTROPY: "acc = 0.0f; for (int i=lcl_id; i<C; i+=grp_s) acc += y[i]*(lse-x[i]);" + \
+            block_reduce("A+B") + "if (lcl_id == 0) ret[row] = acc;",
+        SoftmaxOps.SPARSE_SOFTMAX_CROSS_ENTROPY: "if (lcl_id == 0) ret[row] = bad ? NAN : lse-x[y];",
+        SoftmaxOps.SPARSE_SOFTMAX_CROSS_ENTROPY_GRAD: "float g = bad ? NAN : grad[row*g_s+g_ofst];" + \
+            "for (int i=lcl_id; i<C; i+=grp_s) ret[row*C+i] = (exp(x[i]-lse)-(i==y?1.0f:0.0f))*g;"
+    }[op_info.operator]
+    # NOTE: sparse labels and grad are indexed per row with their strides, no need to be contiguous.
+    # A label out of [0, C) is clamped for the loads and its row is set to nan, instead of reading out of bounds
+    params = ""
+    if xent: params = "int y_ofst, __global const float *lbl, "
+    if sparse: params = "int y_s, int y_ofst, __global const int *lbl, "
+    if op_info.operator == SoftmaxOps.SPARSE_SOFTMAX_CROSS_ENTROPY_GRAD:
+        params += "int g_s, int g_ofst, __global const float *grad, "
+    op = cl.build("softmax_op", f"""
+    __kernel void softmax_op(
+      int C, int x_ofst, {params}
+      __global const float *inp, __local float *lcl, __global float *ret
+    ) {{
+      int row=get_group_id(0), lcl_id=get_local_id(0), grp_s=get_local_size(0);
+      __global const float *x = inp + row*C + x_ofst;
+      {'__global const float *y = lbl + row*C + y_ofst;' if xent else ''}
+      {'int y = lbl[row*y_s+y_ofst]; bool bad = y<0 || y>=C; y = clamp(y, 0, C-1);' if sparse else ''}
+      float acc = -INFINITY;
+      for (int i=lcl_id; i<C; i+=grp_s) acc = max(acc, x[i]);
+      {block_reduce("max(A,B)")}
+      float m = acc;
+      acc = 0.0f;
+      for (int i=lcl_id; i<C; i+=grp_s) acc += exp(x[i]-m);
+      {block_reduce("A+B")}
+      float lse = m + log(acc);
+      {epilogue}
+    }}
+    """)
+    args = [int32(C), int32(x.offset)]
+    if xent: args += [int32(rest[0].offset), rest[0].buffer]
+    if sparse: args += [int32(rest[0].strides[0]), int32(rest[0].offset), rest[0].buffer]
+    if op_info.operator == SoftmaxOps.SPARSE_SOFTMAX_CROSS_ENTROPY_GRAD:
+        args += [int32(rest[1].strides[0]), int32(rest[1].offset), rest[1].buffer]
     local_mem = cl.alloc_local(x.dtype().itemsize * grp_size)
-    local_size = tuple(grp_size if i == axis else 1 for i in range(ndim))
-    e = op(global_size, local_size, int32(size), int32(x.offset), x.buffer, local_mem, ret.buffer)
-    if DEBUG: print(f"[DEBUG] x_shp: {x_shp} ret_shape: {ret_shape} grp_size: {grp_size} n_grps: {n_grps} size: {size} global_size: {global_size} local_size: {local_size} axis={axis} ndim={ndim} offset={offset}")
+    e = op((prod(x.shape[:-1]) * grp_size,), (grp_size,), *args, x.buffer, local_mem, ret.buffer)
     kernelstat.log(op_info.operator)
-    if n_grps > 1:
-        op_info = SimpleNamespace(operator=op_info.operator, operands={"A": ret}, args=op_info.args)
-        ret = reduce_op(op_info)
     return ret
 
 def view_op(op_info):
@@ -257,18 +705,39 @@ def register_elemwise_op(func):
         op_info = SimpleNamespace(operator=op, code=code, operands=dict(zip("AB", inputs)), args=kwargs)
         if not LAZY or (kwargs.get("eager", False) and op == ElemwiseOps.NOOP):
             return invoke(op_info)
+        # NOTE: lazy nodes own their buffers (the output may be fused away), in-place ops rebind to the new node
+        kwargs.pop("out", None)
         return CLArray(shape=inputs[0].shape, dtype=inputs[0].dtype, op_info=op_info, is_lazy=True)
     return wrapper
 
 def register_reduce_op(func):
     def wrapper(x, axis=None, keepdims=False):
         op = func(x, axis=axis, keepdims=keepdims)
+        if axis is None:
+            axes = tuple(range(x.ndim))
+        else:
+            assert op != ReduceOps.ARGMAX or isinstance(axis, int), f"argmax only supports a single axis, got {axis}"
+            axes = tuple(sorted(set(a % x.ndim for a in (axis if isinstance(axis, (tuple, list)) else (axis,)))))
+        ret_shape = tuple(1 if i in axes else s for i, s in enumerate(x.shape) if keepdims or i not in axes)
+        op_info = SimpleNamespace(operator=op, operands={"A": x}, args=dict(axis=axes, keepdims=keepdims, shape=ret_shape))
+        if not LAZY: return invoke(op_info)
+        return CLArray(shape=ret_shape, dtype=x.dtype, op_info=op_info, is_lazy=True)
+    return wrapper
+
+def register_softmax_op(func):
+    def wrapper(x, *inputs):
+        op = func(x, *inputs)
+        if op in (SoftmaxOps.SPARSE_SOFTMAX_CROSS_ENTROPY, SoftmaxOps.SPARSE_SOFTMAX_CROSS_ENTROPY_GRAD):
+            assert x.ndim == 2 and all(i.shape == x.shape[:1] for i in inputs), \
+                    f"Invalid shapes {x.shape} {[i.shape for i in inputs]} for {op}"
+        else:
+            assert all(i.shape == x.shape for i in inputs), f"Shape mismatch {x.shape} {[i.shape for i in inputs]}"
+            inputs = [i.contiguous() if not i.c_contiguous else i for i in inputs]
         x = x.contiguous() if not x.c_contiguous else x
-        op_info = SimpleNamespace(operator=op, operands={"A": x}, args=dict(axis=axis, keepdims=keepdims))
+        op_info = SimpleNamespace(operator=op, operands=dict(zip("ABC", (x, *inputs))), args={})
         if not LAZY: return invoke(op_info)
-        ret_shape = () if axis is None else [d for i, d in enumerate(x.shape) if i != axis]
-        if keepdims: ret_shape.insert(axis, 1)
-        return CLArray(shape=tuple(ret_shape), dtype=x.dtype, op_info=op_info, is_lazy=True)
+        ret_shape = x.shape[:-1] if op in (SoftmaxOps.SOFTMAX_CROSS_ENTROPY, SoftmaxOps.SPARSE_SOFTMAX_CROSS_ENTROPY) else x.shape
+        return CLArray(shape=ret_shape, dtype=x.dtype, op_info=op_info, is_lazy=True)
     return wrapper
 
 def invoke(op_info):
@@ -279,6 +748,8 @@ def invoke(op_info):
         return reduce_op(op_info)
     elif optype is ProcessingOps:
         return matmul_op(op_info)
+    elif optype is SoftmaxOps:
+        return softmax_op(op_info)
     elif optype is ViewOps:
         return next(iter(op_info.operands.values()))
     else:
@@ -321,7 +792,15 @@ class CLArray(Array):
     def numpy(self):
         arr = self.eager() if self.is_lazy else self
         data = np.empty(arr.shape, dtype=arr.dtype)
-        cl.enqueue("copy", data, arr.contiguous(eager=True).buffer, is_blocking=True)
+        # NOTE: the elemwise copy kernel is float only, copy other dtypes from the buffer directly
+        if arr.dtype != float32:
+            assert arr.c_contiguous and not arr.offset, f"Can not copy non-contiguous {arr.dtype} array"
+            if arr.constant_value is not None:
+                data.fill(arr.constant_value)
+                return data
+        else:
+            arr = arr.contiguous(eager=True)
+        cl.enqueue("copy", data, arr.buffer, is_blocking=True)
         return data
 
     # ##### Elemwise Ops #####
@@ -332,16 +811,25 @@ class CLArray(Array):
     exec(f"@register_elemwise_op\ndef contiguous(self): return ElemwiseOps.NOOP")
 
     # ##### Reduce Ops #####
-    for op in ("sum", "max"):
+    for op in ("sum", "max", "min", "mean", "argmax"):
         exec(f"@register_reduce_op\ndef {op}(self, axis=None, keepdims=False): return ReduceOps.{op.upper()}")
 
+    # ##### Softmax Ops #####
+    for op in ("softmax", "log_softmax"):
+        exec(f"@register_softmax_op\ndef {op}(self): return SoftmaxOps.{op.upper()}")
+    for op in ("softmax_cross_entropy", "sparse_softmax_cross_entropy"):
+        exec(f"@register_softmax_op\ndef {op}(self, labels): return SoftmaxOps.{op.upper()}")
+    exec(f"@register_softmax_op\ndef sparse_softmax_cross_entropy_grad(self, labels, grad): return SoftmaxOps.SPARSE_SOFTMAX_CROSS_ENTROPY_GRAD")
+
     # ##### Processing Ops #####
-    def matmul(self, other, out=None):
+    def matmul(self, other, out=None, trans_a=False, trans_b=False):
         a, b = self, other
+        trans_a, trans_b = trans_a and a.ndim > 1, trans_b and b.ndim > 1
         squeezes = []
         if a.ndim == 1: a = a.reshape((1, *a.shape)); squeezes.append(0)
         if b.ndim == 1: b = b.reshape((*b.shape, 1)); squeezes.append(-1)
-        ret_shape = tuple((*a.shape[:-1], b.shape[-1]))
+        M, K = a.shape[-2:][::-1] if trans_a else a.shape[-2:]
+        ret_shape = tuple((*a.shape[:-2], M, b.shape[-2] if trans_b else b.shape[-1]))
 
         if a.ndim > 3: a = a.reshape((prod(a.shape[:-2]), *a.shape[2:]))
         if b.ndim > 3: b = b.reshape((prod(b.shape[:-2]), *b.shape[2:]))
@@ -351,10 +839,10 @@ class CLArray(Array):
             assert a.shape[0] == 1 or b.shape[0] == 1
             if a.shape[0] == 1 and b.shape[0] != 1: a = a.expand((b.shape[0], *a.shape[1:]))
             if b.shape[0] == 1 and a.shape[0] != 1: b = b.expand((a.shape[0], *b.shape[1:]))
-        assert a.shape[0] == b.shape[0] and a.shape[2] == b.shape[1], \
-                f"invalid shape for matmul {a.shape} @ {b.shape}"
+        assert a.shape[0] == b.shape[0] and K == b.shape[2 if trans_b else 1], \
+                f"invalid shape for matmul {a.shape} @ {b.shape} (trans_a={trans_a}, trans_b={trans_b})"
         operands = {"A": a, "B": b}
-        args = {"out": out}
+        args = {"out": out, "trans_a": trans_a, "trans_b": trans_b}
         op_info = SimpleNamespace(operator=ProcessingOps.MATMUL, operands=operands, args=args, ret_shape=ret_shape)
         arr = invoke(op_info) if not LAZY else CLArray(shape=ret_shape, dtype=a.dtype, op_info=op_info, is_lazy=True)
         for axis in squeezes:
@@ -425,9 +913,9 @@ class CLArray(Array):
                 assert 0 <= start < stop <= inst.shape[i], f"Invalid slicing {key[i]} for tensor {inst.shape}"
                 shape[i] = stop - start
                 inst.offset += inst.strides[i] * start
-                inst.c_contiguous, inst.f_contiguous = inst._calculate_contiguity()
         inst.shape = tuple(s for i, s in enumerate(shape) if i not in reduce)
         inst.strides = tuple(s for i, s in enumerate(inst.strides) if i not in reduce)
+        inst.c_contiguous, inst.f_contiguous = inst._calculate_contiguity()
         return inst
 
     def __setitem__(self, key, value):
@@ -444,7 +932,8 @@ class CLArray(Array):
     @classmethod
     def full(cls, shape, value, dtype=float32):
         inst = cls(shape=shape, dtype=dtype)
-        cl.enqueue("fill_buffer", inst.buffer, inst.dtype(value), 0, inst.size)
+        # NOTE: pooled buffers can be larger than requested, only fill the bytes of the array
+        cl.enqueue("fill_buffer", inst.buffer, inst.dtype(value), 0, inst.dtype().itemsize * prod(inst.shape))
         return inst
 
     @classmethod
@@ -466,50 +955,10 @@ class CLArray(Array):
         return self
 
     def eager(self):
-        def recursive_eager(node):
-            for dep_node in node.op_info.operands.values():
-                if dep_node.is_lazy:
-                    recursive_eager(dep_node)
+        GraphOptimizer(root=self).optimize()
+        for node in toposort(self, lazy_only=True):
             if node.is_lazy:
-                eager = invoke(node.op_info)
-                node.update_from_eager(eager)
-
-        graphoptimizer = GraphOptimizer(root=self)
-        graphoptimizer._rename_operands(self)
-        # naive graph
-        if GRAPH:
-            graph_name = "net"
-            print(f"[GRAPH] {graphoptimizer.count(self)} nodes")
-            graphoptimizer.visualize(self, graph_name)
-        # opt1: view op pruning
-        if OPT_VIEWOP_PRUNING:
-            graphoptimizer._viewop_pruning(self)
-            if GRAPH:
-                print(f"[GRAPH] OPT_VIEWOP_PRUNING: #nodes={graphoptimizer.count(self)}")
-                graph_name += "_1"
-                graphoptimizer.visualize(self, graph_name)
-        # opt2: constant folding
-        if OPT_CONSTANT_FOLDING:
-            graphoptimizer._constant_folding(self)
-            if GRAPH:
-                print(f"[GRAPH] OPT_CONSTANT_FOLDING: #nodes={graphoptimizer.count(self)}")
-                graph_name += "_2"
-                graphoptimizer.visualize(self, graph_name)
-        # opt3: elemwise fusion
-        if OPT_ELEMWISE_FUSION:
-            graphoptimizer._elemwise_fusion(self)
-            if GRAPH:
-                graph_name += "_3"
-                print(f"[GRAPH] OPT_ELEMWISE_FUSION: #nodes={graphoptimizer.count(self)}")
-                graphoptimizer.visualize(self, graph_name)
-        # opt4: elemwise processing fusion
-        if OPT_ELEMWISE_PROCESSING_FUSION:
-            graphoptimizer._elemwise_processing_fusion(self)
-            if GRAPH:
-                graph_name += "_4"
-                print(f"[GRAPH] OPT_ELEMWISE_PROCESSING_FUSION: #nodes={graphoptimizer.count(self)}")
-                graphoptimizer.visualize(self, graph_name)
-        recursive_eager(node=self)
+                node.update_from_eager(invoke(node.op_info))
         return self
 
     def _calculate_contiguity(self):
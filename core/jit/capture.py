@@ -0,0 +1,41 @@
+import numpy as np
+
+import core.backend.numpy as npbackend
+from core.backend.numpy import tape
+from core.tensor import Tensor
+
+class StaticGraph:
+    """A captured step replayed as a flat loop of numpy calls writing into preallocated buffers"""
+    def __init__(self, entries, inputs, outputs):
+        self.entries = entries
+        self.inputs = inputs
+        self.outputs = outputs
+
+    def __len__(self):
+        return len(self.entries)
+
+    def replay(self, *data):
+        assert len(data) == len(self.inputs), f"Expect {len(self.inputs)} inputs, got {len(data)}"
+        for ts, d in zip(self.inputs, data):
+            d = d.array.data if isinstance(d, Tensor) else np.asarray(d)
+            assert d.shape == ts.shape, f"Can not replay with shape {d.shape}, captured with {ts.shape}"
+            np.copyto(ts.array.data, d)
+        for fn, inputs, out in self.entries:
+            fn(*inputs, out=out)
+        return self.outputs
+
+def capture(step, *inputs):
+    """Run step(*inputs) once and record every NPArray op it invokes into a StaticGraph.
+
+    Replaying the graph feeds new data into the buffers of `inputs` and returns the outputs of the
+    captured call, updated in-place. The step should have run eagerly at least once so that the
+    optimizer states exist, and python scalars (e.g. the learning rate) are frozen at capture time.
+    """
+    assert not any(ts._gpu for ts in inputs), "Capture only supports tensors on cpu device"
+    assert not npbackend.LAZY, "Capture does not support lazy mode"
+    tape.start()
+    try:
+        outputs = step(*inputs)
+    finally:
+        entries = tape.stop()
+    return StaticGraph(entries, inputs, outputs)
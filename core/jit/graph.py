@@ -1,147 +1,512 @@
 import copy
+import math
 import os
-from collections import defaultdict
+import re
+from collections import OrderedDict, defaultdict, namedtuple
+from functools import cached_property
 
 import networkx as nx
 import numpy as np
 from types import SimpleNamespace
 
-from core.backend.base import ElemwiseOps, ProcessingOps, ReduceOps, ViewOps, CreationOps
+from core.backend.base import Array, ElemwiseOps, ProcessingOps, ReduceOps, ViewOps, CreationOps
 from env import *
 from utils.helper import varnamegetter
 
+NodeRef = namedtuple("NodeRef", ["index"])
+
+class GraphCache:
+    """Optimized graphs keyed by the structure of the lazy graph (operators, args, shapes, strides, constants and
+    the OPT_* flags). A plan is the state of every lazy node after the passes with the nodes referenced by their
+    position in the graph, a graph of the same structure (e.g. the next training step) skips the passes"""
+    def __init__(self, size=GRAPH_CACHE_SIZE):
+        self.size = size
+        self.plans = OrderedDict()
+        self.info = {"hits": 0, "misses": 0}
+
+    def get(self, key):
+        plan = self.plans.get(key)
+        self.info["hits" if plan is not None else "misses"] += 1
+        if plan is not None: self.plans.move_to_end(key)
+        return plan
+
+    def put(self, key, plan):
+        self.plans[key] = plan
+        if len(self.plans) > self.size:
+            self.plans.popitem(last=False)
+
+    def clear(self):
+        self.plans.clear()
+
+graph_cache = GraphCache()
+
+def encode(obj, index):
+    """Replace the arrays in the (nested) args by their position in the graph"""
+    if isinstance(obj, Array): return NodeRef(index[id(obj)])
+    if isinstance(obj, dict): return {k: encode(v, index) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)): return type(obj)(encode(v, index) for v in obj)
+    return obj
+
+def decode(obj, nodes):
+    if isinstance(obj, NodeRef): return nodes[obj.index]
+    if isinstance(obj, dict): return {k: decode(v, nodes) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)): return type(obj)(decode(v, nodes) for v in obj)
+    return obj
+
+def toposort(root, lazy_only=False):
+    """Nodes of the graph of root in post order (operands first), without recursion. With lazy_only, the operands
+    of the eager nodes are not walked"""
+    order, visited = [], {id(root)}
+    stack = [(root, iter(root.op_info.operands.values()))]
+    while stack:
+        node, deps = stack[-1]
+        for dep_node in deps:
+            if id(dep_node) not in visited:
+                visited.add(id(dep_node))
+                walk = not lazy_only or dep_node.is_lazy
+                stack.append((dep_node, iter(dep_node.op_info.operands.values() if walk else ())))
+                break
+        else:
+            stack.pop()
+            order.append(node)
+    return order
+
+def constant_key(value):
+    # NOTE: -0.0 equals 0.0, the sign tells them apart (e.g. 1/-0.0)
+    return value if value is None else (value, math.copysign(1.0, value))
+
+def same_layout(a, b):
+    """Whether a and b read the same elements of a buffer of the same dtype"""
+    return tuple(a.shape) == tuple(b.shape) and tuple(a.strides) == tuple(b.strides) and \
+        getattr(a, "offset", 0) == getattr(b, "offset", 0) and a.dtype == b.dtype
+
+# NOTE: code of the unfused elemwise ops of both backends, a fused op (e.g. left by a previous graph) does not match
+ELEMWISE_PATTERNS = {
+    ElemwiseOps.NOOP: r"(\w+)", ElemwiseOps.NEG: r"\(?-(\w+)\)?", ElemwiseOps.EXP: r"(?:np\.)?exp\((\w+)\)",
+    ElemwiseOps.LOG: r"(?:np\.)?log\((\w+)\)", ElemwiseOps.ADD: r"(\w+)\+(\w+)", ElemwiseOps.SUB: r"(\w+)-(\w+)",
+    ElemwiseOps.MUL: r"(\w+)\*(\w+)", ElemwiseOps.DIV: r"(\w+)/(\w+)"
+}
+
+def match(node, operator):
+    """Operands of a lazy node computing the unfused elemwise operator, in the order of its code"""
+    op_info = node.op_info
+    if not node.is_lazy or op_info.operator is not operator:
+        return None
+    m = re.fullmatch(ELEMWISE_PATTERNS[operator], op_info.code)
+    if m is None or not all(name in op_info.operands for name in m.groups()):
+        return None
+    return [op_info.operands[name] for name in m.groups()]
+
+# NOTE: rewrite rules of the algebraic simplification by name, in the order they are tried. A rule returns the node
+# computing the same value with the same layout to use instead of node, a new op_info for node, or None
+SIMPLIFY_RULES = {}
+
+def simplify_rule(*operators):
+    def register(rule):
+        rule.operators = operators
+        SIMPLIFY_RULES[rule.__name__] = rule
+        return rule
+    return register
+
+def identity_operand(node, operator, value, commutative=False):
+    operands = match(node, operator)
+    if operands is None:
+        return None
+    for x, c in (operands, operands[::-1]) if commutative else (operands,):
+        if c.constant_value is not None and c.constant_value == value and same_layout(x, node):
+            return x
+
+@simplify_rule(ElemwiseOps.MUL)
+def mul_one(node): return identity_operand(node, ElemwiseOps.MUL, 1.0, commutative=True)
+
+@simplify_rule(ElemwiseOps.DIV)
+def div_one(node): return identity_operand(node, ElemwiseOps.DIV, 1.0)
+
+@simplify_rule(ElemwiseOps.ADD)
+def add_zero(node): return identity_operand(node, ElemwiseOps.ADD, 0.0, commutative=True)
+
+@simplify_rule(ElemwiseOps.SUB)
+def sub_zero(node): return identity_operand(node, ElemwiseOps.SUB, 0.0)
+
+def inverse_operand(node, operator, inner_operator):
+    operands = match(node, operator)
+    inner_operands = match(operands[0], inner_operator) if operands else None
+    if inner_operands and same_layout(inner_operands[0], node):
+        return inner_operands[0]
+
+@simplify_rule(ElemwiseOps.NEG)
+def neg_neg(node): return inverse_operand(node, ElemwiseOps.NEG, ElemwiseOps.NEG)
+
+@simplify_rule(ElemwiseOps.EXP)
+def exp_log(node):
+    # NOTE: exp(log(x)) is nan for x < 0, the rewrite assumes x is in the domain of log
+    return inverse_operand(node, ElemwiseOps.EXP, ElemwiseOps.LOG)
+
+@simplify_rule(ElemwiseOps.NOOP)
+def noop_contiguous(node):
+    operands = match(node, ElemwiseOps.NOOP)
+    if operands and same_layout(operands[0], node):
+        return operands[0]
+
+def inner_view(node):
+    """Operand of node if it is a view of the same operator whose layout is given by its args, i.e. not a slice
+    sharing the op_info of the view"""
+    (inner,) = node.op_info.operands.values()
+    if inner.op_info.operator is not node.op_info.operator:
+        return None
+    (x,) = inner.op_info.operands.values()
+    args = inner.op_info.args
+    shape = tuple(x.shape[a] for a in args["axes"]) if "axes" in args else tuple(args["shape"])
+    return inner if shape == tuple(inner.shape) else None
+
+@simplify_rule(ViewOps.PERMUTE)
+def permute_permute(node):
+    inner = inner_view(node)
+    if inner is None:
+        return None
+    axes = tuple(inner.op_info.args["axes"][a] for a in node.op_info.args["axes"])
+    return SimpleNamespace(operator=ViewOps.PERMUTE, operands=dict(inner.op_info.operands), args={"axes": axes})
+
+@simplify_rule(ViewOps.RESHAPE)
+def reshape_reshape(node):
+    inner = inner_view(node)
+    # NOTE: the strides of a reshape depend on the contiguity of its operand
+    if inner is None or not next(iter(inner.op_info.operands.values())).c_contiguous:
+        return None
+    return SimpleNamespace(operator=ViewOps.RESHAPE, operands=dict(inner.op_info.operands), args=dict(node.op_info.args))
+
+@simplify_rule(ViewOps.EXPAND)
+def expand_expand(node):
+    inner = inner_view(node)
+    if inner is None:
+        return None
+    return SimpleNamespace(operator=ViewOps.EXPAND, operands=dict(inner.op_info.operands), args=dict(node.op_info.args))
+
+@simplify_rule(ViewOps.PERMUTE, ViewOps.RESHAPE, ViewOps.EXPAND)
+def identity_view(node):
+    (x,) = node.op_info.operands.values()
+    return x if same_layout(x, node) else None
+
+class Graph:
+    """Topological order and use counts of the nodes of a lazy graph, computed once and shared by the passes.
+    A rewrite reports the operands it replaced with update(), the uses of a node left without users are dropped"""
+    def __init__(self, root):
+        self.root = root
+        self.nodes = toposort(root)
+        self.rewritten = False
+
+    @cached_property
+    def outdegree(self):
+        outdegree = defaultdict(int)
+        for node in self.nodes:
+            for dep_node in node.op_info.operands.values():
+                outdegree[id(dep_node)] += 1
+        return outdegree
+
+    def live(self):
+        """Nodes still used by the graph, a node is only dropped by the rewrite of a later node, i.e. after a pass
+        has visited it"""
+        if not self.rewritten: return self.nodes
+        outdegree = self.outdegree
+        return [node for node in self.nodes if outdegree[id(node)] > 0 or node is self.root]
+
+    def update(self, old_deps, new_deps):
+        # NOTE: the order stays valid, the new operands of a node always come from its old operands' subgraphs
+        self.rewritten = True
+        for dep_node in new_deps:
+            self.outdegree[id(dep_node)] += 1
+        stack = list(old_deps)
+        while stack:
+            dep_node = stack.pop()
+            self.outdegree[id(dep_node)] -= 1
+            if self.outdegree[id(dep_node)] == 0:
+                stack.extend(dep_node.op_info.operands.values())
+
 class GraphOptimizer:
+    # NOTE: nodes and kernels removed by the common subexpression elimination, and rewrites by each of the
+    # SIMPLIFY_RULES since the start
+    info = {"cse_nodes": 0, "cse_kernels": 0, "simplified": defaultdict(int)}
+
     def __init__(self, root):
         assert root.is_lazy
         self.root = root
         varnamegetter.reset()
 
-    def _rename_operands(self, root):
-        def rename_operands(node):
-            operands = {}
+    def optimize(self):
+        """Run the passes enabled by the OPT_* flags on the graph of root, in place"""
+        root = self.root
+        self.graph = Graph(root)
+        key = self._signature(self.graph.nodes) if graph_cache.size and not GRAPH else None
+        plan = graph_cache.get(key) if key is not None else None
+        if plan is not None:
+            self._apply_plan(self.graph.nodes, plan)
+            return root
+        # NOTE: count the uses before any rewrite, the passes report a rewrite with update() once it is made
+        self.graph.outdegree
+        # NOTE: duplicates are merged before the operands are named, the merged node is named once
+        if OPT_ALGEBRAIC_SIMPLIFICATION:
+            self._algebraic_simplification()
+        if OPT_CSE:
+            self._common_subexpression_elimination()
+        self._rename_operands()
+        # naive graph
+        if GRAPH:
+            graph_name = "net"
+            print(f"[GRAPH] {self.count(root)} nodes")
+            self.visualize(root, graph_name)
+        passes = ((OPT_VIEWOP_PRUNING, "OPT_VIEWOP_PRUNING", self._viewop_pruning),
+                  (OPT_CONSTANT_FOLDING, "OPT_CONSTANT_FOLDING", self._constant_folding),
+                  (OPT_ELEMWISE_FUSION, "OPT_ELEMWISE_FUSION", self._elemwise_fusion),
+                  (OPT_ELEMWISE_PROCESSING_FUSION, "OPT_ELEMWISE_PROCESSING_FUSION", self._elemwise_processing_fusion),
+                  (OPT_ELEMWISE_REDUCE_FUSION, "OPT_ELEMWISE_REDUCE_FUSION", self._elemwise_reduce_fusion))
+        for i, (enabled, name, opt_pass) in enumerate(passes):
+            if not enabled: continue
+            opt_pass()
+            if GRAPH:
+                graph_name += f"_{i+1}"
+                print(f"[GRAPH] {name}: #nodes={self.count(root)}")
+                self.visualize(root, graph_name)
+        if key is not None:
+            plan = self._make_plan(self.graph.nodes)
+            if plan is not None: graph_cache.put(key, plan)
+        return root
+
+    def _signature(self, nodes):
+        """Structural key of the graph, the nodes are referenced by their position in the topological order"""
+        index = {id(node): i for i, node in enumerate(nodes)}
+        flags = (OPT_ALGEBRAIC_SIMPLIFICATION, OPT_CSE, OPT_VIEWOP_PRUNING, OPT_CONSTANT_FOLDING, OPT_ELEMWISE_FUSION, OPT_ELEMWISE_PROCESSING_FUSION,
+                 OPT_ELEMWISE_REDUCE_FUSION)
+        key = [flags]
+        # NOTE: the key holds every node attribute a pass reads. Constants are passed to the kernels when they run,
+        # their values are only read by folding (baked into the plan), the simplification rules and the cse.
+        # The offset of a view is compared by the simplification rules and the cse
+        values = OPT_CONSTANT_FOLDING or OPT_ALGEBRAIC_SIMPLIFICATION or OPT_CSE
+        for node in nodes:
+            const = constant_key(node.constant_value) if values else node.constant_value is not None
+            sig = (node.is_lazy, tuple(node.shape), tuple(node.strides), getattr(node, "offset", 0), node.dtype, const)
+            if node.is_lazy:
+                op_info = node.op_info
+                sig += (op_info.operator, getattr(op_info, "code", None),
+                        tuple((name, index[id(dep_node)]) for name, dep_node in op_info.operands.items()),
+                        tuple((k, tuple(v) if type(v) is list else v) for k, v in op_info.args.items()))
+            key.append(sig)
+        return tuple(key)
+
+    def _make_plan(self, nodes):
+        """Record the optimized op_infos of the lazy nodes and the nodes folded to constants"""
+        index = {id(node): i for i, node in enumerate(nodes)}
+        lazy, const = [], []
+        try:
+            for i, node in enumerate(nodes):
+                if node.is_lazy:
+                    attrs = {k: v for k, v in vars(node.op_info).items() if k not in ("operands", "args")}
+                    operands = tuple((name, index[id(dep_node)]) for name, dep_node in node.op_info.operands.items())
+                    args = encode(node.op_info.args, index)
+                    lazy.append((i, attrs, operands, args, node.constant_value))
+                elif node.constant_value is not None:
+                    const.append((i, node.constant_value))
+        except KeyError:
+            return None  # NOTE: an array out of the graph (e.g. an output buffer), do not cache
+        return lazy, const
+
+    def _apply_plan(self, nodes, plan):
+        lazy, const = plan
+        for i, value in const:
+            if nodes[i].is_lazy: nodes[i].to_constant(value)
+        for i, attrs, operands, args, constant_value in lazy:
+            node = nodes[i]
+            # NOTE: decode builds new args, passes of a later graph may update the args of a node left lazy
+            node.op_info = SimpleNamespace(**attrs, operands={name: nodes[j] for name, j in operands},
+                                           args=decode(args, nodes))
+            node.constant_value = constant_value
+
+    def _rename_operands(self):
+        name_dict = defaultdict(varnamegetter.get)
+        for node in self.graph.nodes:
+            operands, names = {}, {}
             for name, dep_node in node.op_info.operands.items():
-                if not visited[id(dep_node)]:
-                    rename_operands(dep_node)
-                new_name = name_dict[id(dep_node)]
-                operands[new_name] = dep_node
-                if type(node.op_info.operator) is ElemwiseOps:
-                    node.op_info.code = node.op_info.code.replace(name, new_name)
+                names[name] = name_dict[id(dep_node)]
+                # NOTE: an operator without code takes its operands by position, e.g. x @ x after the cse
+                if names[name] in operands and not hasattr(node.op_info, "code"):
+                    names[name] = varnamegetter.get()
+                operands[names[name]] = dep_node
+            # NOTE: substitute all names at once, a node left lazy by a previous graph (e.g. fused away)
+            # is renamed again and its old names can collide with the new ones
+            if hasattr(node.op_info, "code") and names:
+                pattern = "|".join(re.escape(name) for name in sorted(names, key=len, reverse=True))
+                node.op_info.code = re.sub(rf"\b({pattern})\b", lambda m: names[m.group(1)], node.op_info.code)
             node.op_info.operands = operands
-            visited[id(node)] = True
 
-        visited = defaultdict(bool)
-        name_dict = defaultdict(varnamegetter.get)
-        rename_operands(root)
+    def _algebraic_simplification(self):
+        """Rewrite the nodes with the SIMPLIFY_RULES of their operator, the users of a node equal to another node
+        (e.g. x*1, exp(log(x)) or an identity view) use that node instead"""
+        rules = defaultdict(list)
+        for rule in SIMPLIFY_RULES.values():
+            for operator in rule.operators:
+                rules[operator].append(rule)
+        replaced = {}
+        for node in self.graph.live():
+            operands = node.op_info.operands
+            if any(id(dep_node) in replaced for dep_node in operands.values()):
+                deps = list(operands.values())
+                node.op_info.operands = {name: replaced.get(id(dep_node), dep_node) for name, dep_node in operands.items()}
+                self.graph.update(deps, node.op_info.operands.values())
+            for rule in rules[node.op_info.operator]:
+                ret = rule(node)
+                if ret is None:
+                    continue
+                if isinstance(ret, Array):
+                    # NOTE: the root keeps computing its value, the graph has no user to redirect
+                    if node is self.root: continue
+                    replaced[id(node)] = ret
+                    GraphOptimizer.info["simplified"][rule.__name__] += 1
+                    break
+                # NOTE: a new op_info, the one of a view may be shared with its slices
+                deps = list(node.op_info.operands.values())
+                node.op_info = ret
+                self.graph.update(deps, ret.operands.values())
+                GraphOptimizer.info["simplified"][rule.__name__] += 1
+        if GRAPH: print(f"[GRAPH] OPT_ALGEBRAIC_SIMPLIFICATION: {dict(GraphOptimizer.info['simplified'])}")
 
-    def _constant_folding(self, root):
-        def constant_folding(node):
-            if node.constant_value is not None:
-                return True
-            dep_is_const = []
-            for name, dep_node in node.op_info.operands.items():
-                if id(dep_node) not in cache:
-                    flag = constant_folding(dep_node)
-                    cache[id(dep_node)] = flag
-                dep_is_const.append(cache[id(dep_node)])
-
-            is_const = False
-            if any(dep_is_const):
-                if isinstance(node.op_info.operator, ViewOps):
-                    dep_node = next(iter(node.op_info.operands.values()))
-                    node.to_constant(dep_node.constant_value)
-                    is_const = True
-                if isinstance(node.op_info.operator, ElemwiseOps):
-                    if all(dep_is_const) and len(dep_is_const) > 1:  # NOTE: skip unary ops
-                        expr = node.op_info.code
-                        for name, dep_node in node.op_info.operands.items():
-                            expr = expr.replace(name, f"{dep_node.constant_value:.15f}f")
-                        node.to_constant(eval(expr.replace("f", "")))
-                        is_const = True
-            return is_const
-
-        cache = {}
-        constant_folding(root)
-
-    def _elemwise_fusion(self, root):
-        def elemwise_fusion(node):
+    def _common_subexpression_elimination(self):
+        """Merge the lazy nodes (and eager views) computing the same operator with the same args on the same operands
+        into the first one, and the constants of the same value"""
+        canonical, merged = {}, {}
+        removed_nodes = removed_kernels = 0
+        for node in self.graph.live():
+            operands = node.op_info.operands
+            if any(id(dep_node) in merged for dep_node in operands.values()):
+                deps = list(operands.values())
+                node.op_info.operands = {name: merged.get(id(dep_node), dep_node) for name, dep_node in operands.items()}
+                self.graph.update(deps, node.op_info.operands.values())
+            if node is self.root:
+                continue
+            # NOTE: an eager view of the same array with the same args shares its memory as well
+            if node.is_lazy or (type(node.op_info.operator) is ViewOps and node.constant_value is None):
+                op_info = node.op_info
+                key = (node.is_lazy, op_info.operator, getattr(op_info, "code", None),
+                       tuple((name, id(dep_node)) for name, dep_node in op_info.operands.items()),
+                       tuple((k, tuple(v) if type(v) is list else v) for k, v in op_info.args.items()),
+                       getattr(node, "offset", 0))
+            elif node.constant_value is not None:
+                key = ("constant", constant_key(node.constant_value))
+            else:
+                continue
+            key += (tuple(node.shape), tuple(node.strides), node.dtype)
+            try:
+                first = canonical.setdefault(key, node)
+            except TypeError:
+                continue  # NOTE: unhashable args, keep the node
+            if first is not node:
+                merged[id(node)] = first
+                removed_nodes += 1
+                removed_kernels += node.is_lazy and type(node.op_info.operator) is not ViewOps
+        GraphOptimizer.info["cse_nodes"] += removed_nodes
+        GraphOptimizer.info["cse_kernels"] += removed_kernels
+        if GRAPH: print(f"[GRAPH] OPT_CSE: removed {removed_nodes} nodes, {removed_kernels} kernels")
+
+    def _constant_folding(self):
+        for node in self.graph.live():
+            if node.constant_value is not None or not node.op_info.operands:
+                continue
+            deps = list(node.op_info.operands.values())
+            dep_is_const = [dep_node.constant_value is not None for dep_node in deps]
+            if not any(dep_is_const):
+                continue
+            if isinstance(node.op_info.operator, ViewOps):
+                node.to_constant(deps[0].constant_value)
+                self.graph.update(deps, [])
+            elif isinstance(node.op_info.operator, ElemwiseOps):
+                if all(dep_is_const) and len(dep_is_const) > 1:  # NOTE: skip unary ops
+                    expr = node.op_info.code
+                    for name, dep_node in node.op_info.operands.items():
+                        expr = re.sub(rf"\b{re.escape(name)}\b", f"{dep_node.constant_value:.15f}f", expr)
+                    node.to_constant(eval(expr.replace("f", "")))
+                    self.graph.update(deps, [])
+
+    def _elemwise_fusion(self):
+        outdegree = self.graph.outdegree
+        for node in self.graph.live():
+            if type(node.op_info.operator) is not ElemwiseOps or not node.c_contiguous:
+                continue
             for name in list(node.op_info.operands):
                 dep_node = node.op_info.operands[name]
-                if not dep_node.is_lazy:
-                    continue
-                if not visited[id(dep_node)]:
-                    elemwise_fusion(dep_node)
-                if type(node.op_info.operator) is ElemwiseOps and \
-                        type(dep_node.op_info.operator) is ElemwiseOps and \
-                        node.c_contiguous and dep_node.c_contiguous and \
-                        outdegree[id(dep_node)] == 1:
+                if dep_node.is_lazy and type(dep_node.op_info.operator) is ElemwiseOps and \
+                        dep_node.c_contiguous and outdegree[id(dep_node)] == 1:
                     node.op_info.operands.pop(name)
                     node.op_info.operands.update(dep_node.op_info.operands)
-                    node.op_info.code = node.op_info.code.replace(name, f"({dep_node.op_info.code})")
-            visited[id(node)] = True
+                    node.op_info.code = re.sub(rf"\b{re.escape(name)}\b", lambda m: f"({dep_node.op_info.code})",
+                                               node.op_info.code)
+                    self.graph.update([dep_node], dep_node.op_info.operands.values())
 
-        def update_outdegree(node):
-            if visited[id(node)]: return
-            for name, dep_node in node.op_info.operands.items():
-                outdegree[id(dep_node)] += 1
-                update_outdegree(dep_node)
-            visited[id(node)] = True
+    def _viewop_pruning(self):
+        for node in self.graph.live():
+            if type(node.op_info.operator) is not ViewOps:
+                continue
+            dep_node = next(iter(node.op_info.operands.values()))
+            node.op_info = dep_node.op_info
+            node.constant_value = dep_node.constant_value
+            if not dep_node.is_lazy and dep_node.constant_value is None:
+                node.buffer = dep_node.buffer
+            self.graph.update([dep_node], node.op_info.operands.values())
 
-        outdegree = defaultdict(int)
-        visited = defaultdict(bool)
-        update_outdegree(root)
-        visited = defaultdict(bool)
-        elemwise_fusion(root)
-
-    def _viewop_pruning(self, root):
-        def viewop_pruning(node):
-            for name, dep_node in node.op_info.operands.items():
-                if not visited[id(dep_node)]:
-                    viewop_pruning(dep_node)
-                if type(node.op_info.operator) is ViewOps:
-                    node.op_info = dep_node.op_info
-                    node.constant_value = dep_node.constant_value
-                    if not dep_node.is_lazy and dep_node.constant_value is None:
-                        node.buffer = dep_node.buffer
-            visited[id(node)] = True
-        visited = defaultdict(bool)
-        viewop_pruning(root)
-
-    def _elemwise_processing_fusion(self, root):
-        def elemwise_processing_fusion(node):
+    def _elemwise_processing_fusion(self):
+        outdegree = self.graph.outdegree
+        for node in self.graph.live():
+            if type(node.op_info.operator) is not ElemwiseOps:
+                continue
             dep_types = defaultdict(list)
             for name, dep_node in node.op_info.operands.items():
-                if not visited[id(dep_node)]:
-                    elemwise_processing_fusion(dep_node)
                 dep_types[type(dep_node.op_info.operator)].append((name, dep_node))
-            if type(node.op_info.operator) is ElemwiseOps and \
-                    outdegree[id(dep_node)] == 1 and \
+            if outdegree[id(dep_node)] == 1 and \
                     len(dep_types[ProcessingOps]) == 1 and len(dep_types[ReduceOps]) == 0 and \
                     all([not v.is_lazy for k, v in dep_types[ElemwiseOps]]):
+                deps = list(node.op_info.operands.values())
                 name, proc_dep = dep_types[ProcessingOps][0]
-                extra_code = node.op_info.code.replace(name, "acc")
+                extra_code = re.sub(rf"\b{re.escape(name)}\b", "acc", node.op_info.code)
                 extra_operands = {**dict(dep_types[ElemwiseOps]), **dict(dep_types[type(None)])}
                 node.op_info = proc_dep.op_info
                 node.op_info.args["extra"] = {"operands": extra_operands, "code": extra_code}
-            visited[id(node)] = True
+                self.graph.update(deps, [*node.op_info.operands.values(), *extra_operands.values()])
 
-        def update_outdegree(node):
-            if visited[id(node)]: return
-            for name, dep_node in node.op_info.operands.items():
-                outdegree[id(dep_node)] += 1
-                update_outdegree(dep_node)
-            visited[id(node)] = True
-
-        outdegree = defaultdict(int)
-        visited = defaultdict(bool)
-        update_outdegree(root)
-        visited = defaultdict(bool)
-        elemwise_processing_fusion(root)
+    def _elemwise_reduce_fusion(self):
+        # NOTE: the fused nodes get new op_infos, a fused away node may still be evaluated by a later graph
+        outdegree = self.graph.outdegree
+        for node in self.graph.live():
+            op_info = node.op_info
+            # producer: the elemwise expression is computed on load by the reduction
+            if type(op_info.operator) is ReduceOps and not hasattr(op_info, "code"):
+                dep_node = next(iter(op_info.operands.values()))
+                # NOTE: a view pruned into its elemwise dep shares the op_info, its layout must be the computed one
+                if dep_node.is_lazy and type(dep_node.op_info.operator) is ElemwiseOps and \
+                        outdegree[id(dep_node)] == 1 and dep_node.c_contiguous and \
+                        tuple(dep_node.op_info.args["shape"]) == tuple(dep_node.shape) and \
+                        all(v.shape == dep_node.shape for v in dep_node.op_info.operands.values()) and \
+                        any(v.constant_value is None for v in dep_node.op_info.operands.values()):
+                    node.op_info = SimpleNamespace(operator=op_info.operator, code=dep_node.op_info.code,
+                                                   operands=dict(dep_node.op_info.operands), args=op_info.args)
+                    self.graph.update([dep_node], node.op_info.operands.values())
+            # epilogue: the elemwise op is computed on the result of the reduction before it is stored
+            if type(op_info.operator) is ElemwiseOps:
+                reduce_deps = [(name, dep_node) for name, dep_node in op_info.operands.items()
+                               if dep_node.is_lazy and type(dep_node.op_info.operator) is ReduceOps]
+                if len(reduce_deps) == 1:
+                    name, red_dep = reduce_deps[0]
+                    extra_operands = {k: v for k, v in op_info.operands.items() if k != name}
+                    if outdegree[id(red_dep)] == 1 and "extra" not in red_dep.op_info.args and \
+                            red_dep.shape == node.shape and tuple(red_dep.op_info.args["shape"]) == tuple(node.shape) and \
+                            all(v.shape == node.shape and (not v.is_lazy or v.constant_value is not None)
+                                for v in extra_operands.values()):
+                        extra_code = re.sub(rf"\b{re.escape(name)}\b", "acc", op_info.code)
+                        node.op_info = SimpleNamespace(**vars(red_dep.op_info))
+                        node.op_info.args = {**red_dep.op_info.args,
+                                             "extra": {"operands": extra_operands, "code": extra_code}}
+                        self.graph.update([red_dep], node.op_info.operands.values())
 
     def visualize(self, root, graph_name):
         colors = {ReduceOps: "#ecc30b", ElemwiseOps: "#84bcda", ProcessingOps: "#f37748", ViewOps: "#e5e5e5"}
-        def build_graph(node, G):
-            if node is None: return G
-            if id(node) in G.nodes: return G
+        G = nx.DiGraph()
+        for node in toposort(root):
             G.add_node(id(node))
             label = (f"{node.shape}\n"
                      f"{node.strides}\n"
@@ -158,24 +523,13 @@ class GraphOptimizer:
             G.nodes[id(node)]["style"] = "filled, dashed" if node.is_lazy else "filled"
             G.nodes[id(node)]["fillcolor"] = colors.get(type(node.op_info.operator), "#ffffff")
             for name, subnode in node.op_info.operands.items():
-                G = build_graph(subnode, G)
                 edge = (id(subnode), id(node))
                 if edge not in G.edges:
                     G.add_edge(*edge, cnt=1, label=name)
-            return G
-        G = build_graph(root, G=nx.DiGraph())
         nx.drawing.nx_pydot.write_dot(G, f"/tmp/{graph_name}.dot")
         os.system(f"dot -Tsvg /tmp/{graph_name}.dot -o /tmp/{graph_name}.svg")
         print(f"[GRAPH] save to /tmp/{graph_name}.svg")
 
     def count(self, root):
-        def count_node(node):
-            cnt = 0
-            for name, dep_node in node.op_info.operands.items():
-                if not visited[id(dep_node)]:
-                    cnt += count_node(dep_node)
-                cnt += 1
-            visited[id(node)] = True
-            return cnt
-        visited = defaultdict(bool)
-        return count_node(root)
+        # NOTE: the edges of the graph still reachable from root
+        return sum(len(node.op_info.operands) for node in toposort(root))
@@ -1,3 +1,5 @@
+import core.autograd.ops as ops
+
 class Loss:
     def __call__(self, predicted, actual):
         raise NotImplementedError
@@ -5,9 +7,12 @@ class Loss:
 class SoftmaxCrossEntropyLoss(Loss):
     def __call__(self, logits, labels):
         m = logits.shape[0]
-        exps = (logits - logits.max(axis=1, keepdims=True)).exp()
-        p = exps / exps.sum()
-        liklihood = (p * labels).sum(axis=1)
-        nll = -liklihood.log()
+        nll = ops.softmax_cross_entropy(logits, labels)
         return nll.sum() / m
 
+
+class SparseSoftmaxCrossEntropyLoss(Loss):
+    def __call__(self, logits, labels):
+        m = logits.shape[0]
+        nll = ops.sparse_softmax_cross_entropy(logits, labels)
+        return nll.sum() / m
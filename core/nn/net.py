@@ -1,3 +1,6 @@
+from core.autograd.ops import GradMode, no_grad
+from core.tensor import Tensor
+
 class Net:
     def forward(self, x):
         raise NotImplementedError
@@ -17,11 +20,59 @@ class Net:
                 if p is not None: p.zero_grad()
 
 class SequentialNet(Net):
-    def __init__(self, *layers):
+    def __init__(self, *layers, checkpoint_segments=0):
         super().__init__()
         self.layers = layers
+        # NOTE: split layers into segments and only keep the inputs of each segment during forward,
+        # intermediate activations are recomputed when backward reaches the segment
+        self.checkpoint_segments = checkpoint_segments
 
     def forward(self, x):
-        for layer in self.layers:
+        if not self.checkpoint_segments or not GradMode.enabled:
+            return self._forward(self.layers, x)
+        n = min(self.checkpoint_segments, len(self.layers))
+        bounds = [len(self.layers) * i // n for i in range(n + 1)]
+        for i in range(n - 1):
+            x = self._checkpoint(self.layers[bounds[i]:bounds[i+1]], x)
+        # NOTE: the last segment would be recomputed right away, run it normally
+        return self._forward(self.layers[bounds[-2]:], x)
+
+    @staticmethod
+    def _forward(layers, x):
+        for layer in layers:
             x = layer.forward(x)
         return x
+
+    def _checkpoint(self, layers, x):
+        with no_grad():
+            out = self._forward(layers, x)
+        targets = [x] + [p for layer in layers for p in layer.params.values() if p is not None]
+        targets = [(i, ts) for i, ts in enumerate(targets) if ts.requires_grad]
+        if not targets:
+            return out
+
+        cache = {}
+        def recompute(g):
+            # rerun the segment on detached copies of its input and parameters to get their gradients
+            detach = lambda ts: Tensor(ts.array, requires_grad=ts.requires_grad, dtype=ts.dtype)
+            params = [layer.params for layer in layers]
+            for layer in layers:
+                layer.params = {k: detach(v) if v is not None else None for k, v in layer.params.items()}
+            try:
+                inp = detach(x)
+                self._forward(layers, inp).backward(g)
+                leaves = [inp] + [p for layer in layers for p in layer.params.values() if p is not None]
+                cache.update({i: leaves[i].grad for i, _ in targets})
+            finally:
+                for layer, param in zip(layers, params):
+                    layer.params = param
+
+        def grad_fn_for(i):
+            def grad_fn(g):
+                if not cache:
+                    recompute(g)
+                return cache.pop(i)
+            return grad_fn
+
+        dependency = [dict(tensor=ts, grad_fn=grad_fn_for(i)) for i, ts in targets]
+        return Tensor(out.array, requires_grad=True, dependency=dependency, dtype=out.dtype)
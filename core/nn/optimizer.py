@@ -1,37 +1,48 @@
-from collections import defaultdict
-
-from env import LAZY
-
 class Optimizer:
     def __init__(self, params, lr, weight_decay):
         self.lr = lr
         self.weight_decay = weight_decay
         self.t = 0
         self.params = params
+        self._states = {}
 
     def step(self):
         self.t += 1
         for i, param_dict in enumerate(self.params):
             for name, param in param_dict.items():
-                param.array += self._get_step(param.grad, key=f"{i}-{name}")
-                if LAZY:
-                    param.array.eager()
+                key = f"{i}-{name}"
+                # NOTE: the update is written in-place into the parameter, the states and a scratch buffer,
+                # lazy arrays return new nodes instead so that the results are always rebound
+                param.array = self._update(param.array, param.grad, key)
+                if param.array.is_lazy:
+                    for array in (*self._states[key], param.array):
+                        if array.is_lazy: array.eager()
 
-    def _get_step(self, grad):
+    def _get_states(self, key, grad, n):
+        # NOTE: states and the scratch buffer are allocated with the first gradient and reused afterwards
+        if key not in self._states:
+            self._states[key] = tuple(grad.__class__.full(grad.shape, 0.0) for _ in range(n))
+        return self._states[key]
+
+    def _update(self, param, grad, key):
         raise NotImplementedError
 
 class SGD(Optimizer):
     def __init__(self, params, lr=0.01, momentum=0.0, weight_decay=0.0):
         super().__init__(params, lr, weight_decay)
         self._momentum = momentum
-        self._acc = defaultdict(int)
 
-    def _get_step(self, grad, key):
+    def _update(self, param, grad, key):
+        acc, tmp = self._get_states(key, grad, 2)
         if self._momentum:
-            self._acc[key] = self._momentum * self._acc[key] + grad
-            return -self.lr * self._acc[key]
+            acc *= self._momentum
+            acc += grad
+            tmp = acc.mul(acc.asarray(self.lr), out=tmp)
         else:
-            return -self.lr * grad
+            tmp = grad.mul(grad.asarray(self.lr), out=tmp)
+        param -= tmp
+        self._states[key] = (acc, tmp)
+        return param
 
 class RMSProp(Optimizer):
     def __init__(self, params, lr=0.01, decay=0.99, momentum=0.0, epsilon=1e-8, weight_decay=0.0):
@@ -39,25 +50,62 @@ class RMSProp(Optimizer):
         self._rho = decay
         self._momentum = momentum
         self._epsilon = epsilon
-        self._rms, self._mom = defaultdict(int), defaultdict(int)
 
-    def _get_step(self, grad, key):
-        self._rms[key] += (1 - self._rho) * (grad ** 2 - self._rms[key])
-        self._mom[key] = self._momentum * self._mom[key] + self.lr * grad / \
-                (self._rms[key] + self._epsilon)**0.5
-        return -self._mom[key]
+    def _update(self, param, grad, key):
+        rms, mom, tmp = self._get_states(key, grad, 3)
+        # rms += (1 - rho) * (grad^2 - rms)
+        tmp = grad.mul(grad, out=tmp)
+        tmp -= rms
+        tmp *= 1 - self._rho
+        rms += tmp
+        # mom = mom * momentum + lr * grad / sqrt(rms + eps)
+        tmp = rms.add(rms.asarray(self._epsilon), out=tmp)
+        tmp **= 0.5
+        tmp = grad.div(tmp, out=tmp)
+        tmp *= self.lr
+        mom *= self._momentum
+        mom += tmp
+        param -= mom
+        self._states[key] = (rms, mom, tmp)
+        return param
 
 class Adam(Optimizer):
     def __init__(self, params, lr=0.001, beta1=0.9, beta2=0.999, epsilon=1e-8, weight_decay=0.0):
         super().__init__(params, lr, weight_decay)
         self._b1, self._b2, self._epsilon = beta1, beta2, epsilon
-        self._m, self._v = defaultdict(int), defaultdict(int)
+        self._b1_t, self._b2_t = None, None
 
-    def _get_step(self, grad, key):
-        self._m[key] += (1.0 - self._b1) * (grad - self._m[key])
-        self._v[key] += (1.0 - self._b2) * (grad ** 2 - self._v[key])
-        # bias correction
-        _m = self._m[key] / (1 - self._b1 ** self.t)
-        _v = self._v[key] / (1 - self._b2 ** self.t)
-        return -self.lr * _m / (_v ** 0.5 + self._epsilon)
+    def step(self):
+        # NOTE: keep beta1^t and beta2^t in arrays updated in-place instead of python floats,
+        # so that the bias correction stays valid when a captured step is replayed
+        if self._b1_t is None:
+            array_cls = next(p.array.__class__ for param_dict in self.params for p in param_dict.values())
+            self._b1_t, self._b2_t = array_cls.full((1,), 1.0), array_cls.full((1,), 1.0)
+        self._b1_t *= self._b1
+        self._b2_t *= self._b2
+        for array in (self._b1_t, self._b2_t):
+            if array.is_lazy:
+                array.eager()
+        super().step()
 
+    def _update(self, param, grad, key):
+        m, v, tmp = self._get_states(key, grad, 3)
+        # m += (1 - b1) * (grad - m)
+        tmp = grad.sub(m, out=tmp)
+        tmp *= 1.0 - self._b1
+        m += tmp
+        # v += (1 - b2) * (grad^2 - v)
+        tmp = grad.mul(grad, out=tmp)
+        tmp -= v
+        tmp *= 1.0 - self._b2
+        v += tmp
+        # param -= lr * (m / (1 - b1^t)) / (sqrt(v / (1 - b2^t)) + eps)
+        tmp = v.div(1 - self._b2_t, out=tmp)
+        tmp **= 0.5
+        tmp += self._epsilon
+        tmp = m.div(tmp, out=tmp)
+        tmp /= 1 - self._b1_t
+        tmp *= self.lr
+        param -= tmp
+        self._states[key] = (m, v, tmp)
+        return param
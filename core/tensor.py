@@ -1,6 +1,10 @@
+import math
+from functools import lru_cache
+
 import core.autograd.ops as ops
 from env import BACKEND
 from core.dtype import float32
+from utils.helper import genname
 
 from core.backend.numpy import NPArray as CPUArray
 GPUArray = type(None)
@@ -9,19 +13,37 @@ if BACKEND == "opencl":
 elif BACKEND == "cuda":
     from core.backend.cuda import CuArray as GPUArray
 
+@lru_cache(maxsize=1024, typed=True)
+def _scalar_array(array_cls, dtype, value, sign):
+    # NOTE: share one constant array per device/dtype/value, read-only so that an in-place op can not change it.
+    # The sign is part of the key as -0.0 equals 0.0
+    arr = array_cls(value, dtype=dtype)
+    if array_cls is CPUArray: arr.data.flags.writeable = False
+    return arr
+
+def _scalar(array_cls, dtype, value):
+    # NOTE: a new tensor per call, nan is not cached as it never equals the cached key
+    if value != value: return Tensor(array_cls(value, dtype=dtype))
+    return Tensor(_scalar_array(array_cls, dtype, value, math.copysign(1.0, value)))
+
 class Tensor:
+    __slots__ = ("_gpu", "array", "dtype", "_name", "grad", "requires_grad", "dependency", "is_leaf", "retains_grad")
+
     def __init__(self, array, requires_grad=False, dependency=(), dtype=float32, name=None):
-        self._gpu = isinstance(array, GPUArray)
-        self.array = array if isinstance(array, (CPUArray, GPUArray)) else CPUArray(array, dtype=dtype)
-        self.dtype = dtype
-        self.name = name
+        self._gpu = array.__class__ is GPUArray
+        self.array = array if self._gpu or array.__class__ is CPUArray else CPUArray(array, dtype=dtype)
+        self.dtype = self.array.dtype
+        self._name = name
 
         self.grad = None
         self.requires_grad = requires_grad
         self.dependency = dependency
-        self.degree = 0
+        self.is_leaf = not dependency
+        self.retains_grad = False
 
     def astensor(self, obj):
+        if obj.__class__ in (int, float):
+            return _scalar(self.array.__class__, self.dtype, obj)
         if not isinstance(obj, self.__class__):
             if not isinstance(obj, self.array.__class__):
                 obj = self.array.__class__(obj, dtype=self.dtype)
@@ -34,14 +56,25 @@ class Tensor:
 
     def gpu(self):
         assert GPUArray != type(None), f"backend {BACKEND} not support gpu device"
-        return Tensor(GPUArray(self.array.numpy()), requires_grad=self.requires_grad, dtype=self.dtype)
+        return Tensor(GPUArray(self.array.numpy(), dtype=self.dtype), requires_grad=self.requires_grad, dtype=self.dtype)
 
     def cpu(self):
-        return Tensor(CPUArray(self.array.numpy()), requires_grad=self.requires_grad, dtype=self.dtype)
+        return Tensor(CPUArray(self.array.numpy(), dtype=self.dtype), requires_grad=self.requires_grad, dtype=self.dtype)
 
     def numpy(self):
         return self.array.numpy()
 
+    @property
+    def name(self):
+        # NOTE: names of intermediate tensors are only formatted when someone asks for them
+        if self._name.__class__ is tuple:
+            self._name = genname(*self._name)
+        return self._name
+
+    @name.setter
+    def name(self, name):
+        self._name = name
+
     @property
     def shape(self):
         return self.array.shape
@@ -69,31 +102,65 @@ class Tensor:
     for op in ("neg", "getitem"):
         exec(f"def __{op}__(self, *args, **kwargs): return ops.{op}(self, *args, **kwargs)")
 
-    for op in ("sum", "max", "log", "exp", "relu", "expand", "squeeze", "reshape", "flatten", "permute"):
+    for op in ("sum", "max", "min", "mean", "argmax", "log", "exp", "relu", "expand", "squeeze", "reshape", "flatten", "permute",
+               "softmax", "log_softmax"):
         exec(f"def {op}(self, *args, **kwargs): return ops.{op}(self, *args, **kwargs)")
 
     @property
     def T(self):
         return ops.permute(self, axes=None)
 
-    def backward(self, grad=None):
+    def backward(self, grad=None, retain_graph=False):
         assert self.requires_grad, "Call backward() on a non-requires-grad tensor."
-        self.degree -= 1
+        if ops.profile.current is not None:
+            return ops.profile.current.span("backward", self._backward, grad, retain_graph)
+        return self._backward(grad, retain_graph)
+
+    def _backward(self, grad, retain_graph):
         if grad is None:
             grad = GPUArray(1.0) if self._gpu else CPUArray(1.0)
-            self.degree = 0
         if self._gpu and not isinstance(grad, GPUArray):
             grad = GPUArray(grad, dtype=self.dtype)
         if not self._gpu and not isinstance(grad, CPUArray):
             grad = CPUArray(grad, dtype=self.dtype)
 
-        if self.requires_grad:
-            self.grad = self.grad + grad if self.grad is not None else grad
-
-        if self.degree <= 0:
-            for dep in self.dependency:
-                grad_for_dep = dep["grad_fn"](self.grad)
-                dep["tensor"].backward(grad_for_dep)
+        # NOTE: in topological order all consumers of a node are visited before the node itself,
+        # so its gradient is complete when popped from the map and can be released right away
+        grads = {id(self): grad}
+        for node in self._toposort():
+            grad = grads.pop(id(node))
+            assert node.is_leaf or node.dependency, \
+                "Trying to backward through the graph a second time, set retain_graph=True if needed."
+            if node.is_leaf or node.retains_grad:
+                node.grad = node.grad + grad if node.grad is not None else grad
+            for dep in node.dependency:
+                grad_for_dep = dep["grad_fn"](grad)
+                key = id(dep["tensor"])
+                grads[key] = grads[key] + grad_for_dep if key in grads else grad_for_dep
+            # NOTE: grad_fns hold references to the input arrays, free them once they have been run
+            if not retain_graph:
+                node.dependency = ()
+
+    def retain_grad(self):
+        assert self.requires_grad, "Call retain_grad() on a non-requires-grad tensor."
+        self.retains_grad = True
+
+    def _toposort(self):
+        # iterative post-order dfs over the dependency edges, reversed to get root-first order
+        order, visited = [], {id(self)}
+        stack = [(self, iter(self.dependency))]
+        while stack:
+            node, deps = stack[-1]
+            for dep in deps:
+                tensor = dep["tensor"]
+                if id(tensor) not in visited:
+                    visited.add(id(tensor))
+                    stack.append((tensor, iter(tensor.dependency)))
+                    break
+            else:
+                stack.pop()
+                order.append(node)
+        return order[::-1]
 
     def zero_grad(self):
         self.grad = None
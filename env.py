@@ -2,16 +2,28 @@ import os
 
 DEBUG = int(os.getenv("DEBUG", "0"))
 GRAPH = int(os.getenv("GRAPH", "0"))
+PROFILE = int(os.getenv("PROFILE", "0"))
 LAZY = int(os.getenv("LAZY", "0"))
 BACKEND = os.getenv("BACKEND", "opencl")
+NUM_THREADS = int(os.getenv("NUM_THREADS", "1"))
+PARALLEL_THRESHOLD = int(os.getenv("PARALLEL_THRESHOLD", str(1 << 18)))
+CL_CACHE_DIR = os.getenv("CL_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "mvnet", "cl"))
+CL_CACHE_SIZE = int(os.getenv("CL_CACHE_SIZE", str(256 << 20)))
+AUTOTUNE = int(os.getenv("AUTOTUNE", "0"))
+AUTOTUNE_FILE = os.getenv("AUTOTUNE_FILE", os.path.join(os.path.expanduser("~"), ".cache", "mvnet", "autotune.json"))
 
+GRAPH_CACHE_SIZE = int(os.getenv("GRAPH_CACHE_SIZE", "256"))
+
+OPT_ALGEBRAIC_SIMPLIFICATION = int(os.getenv("OPT_ALGEBRAIC_SIMPLIFICATION", "0"))
+OPT_CSE = int(os.getenv("OPT_CSE", "0"))
 OPT_CONSTANT_FOLDING = int(os.getenv("OPT_CONSTANT_FOLDING", "0"))
 OPT_ELEMWISE_FUSION = int(os.getenv("OPT_ELEMWISE_FUSION", "0"))
 OPT_VIEWOP_PRUNING = int(os.getenv("OPT_VIEWOP_PRUNING", "0"))
 OPT_ELEMWISE_PROCESSING_FUSION = int(os.getenv("OPT_ELEMWISE_PROCESSING_FUSION", "0"))
+OPT_ELEMWISE_REDUCE_FUSION = int(os.getenv("OPT_ELEMWISE_REDUCE_FUSION", "0"))
 
 assert BACKEND in ("numpy", "opencl", "cuda"), f"backend {BACKEND} not supported!"
 
 if LAZY:
-    assert BACKEND in ("opencl",), f"currently lazy mode only support opencl backend!"
+    assert BACKEND in ("opencl", "numpy"), f"currently lazy mode only support opencl and numpy backend!"
 
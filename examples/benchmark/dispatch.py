@@ -0,0 +1,43 @@
+import runtime_path  # isort:skip
+
+import argparse
+import time
+
+import numpy as np
+
+from core.autograd.ops import no_grad
+from core.tensor import Tensor
+
+
+def bench(fn, duration):
+    cnt, ts = 0, time.monotonic()
+    while time.monotonic() - ts < duration:
+        fn()
+        cnt += 1
+    return cnt / (time.monotonic() - ts)
+
+def main(args):
+    a = Tensor(np.random.normal(0, 1, (args.size, args.size)), requires_grad=True).to(args.device)
+    b = Tensor(np.random.normal(0, 1, (args.size, args.size)), requires_grad=True).to(args.device)
+    c = Tensor(np.random.normal(0, 1, (args.size, args.size))).to(args.device)
+    cases = {
+        "add": lambda: a + b,
+        "mul_scalar": lambda: a * 2.0,
+        "matmul": lambda: a @ b,
+        "sum": lambda: a.sum(axis=0),
+        "add_no_grad_input": lambda: c + c,
+        "forward_backward": lambda: ((a * b + 1.0).relu().sum()).backward(),
+    }
+    for name, fn in cases.items():
+        print(f"{name:>20s}: {bench(fn, args.duration):10.0f} ops/sec")
+        a.zero_grad(); b.zero_grad()
+    with no_grad():
+        print(f"{'add_no_grad':>20s}: {bench(lambda: a + b, args.duration):10.0f} ops/sec")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", default=4, type=int)
+    parser.add_argument("--duration", default=1.0, type=float)
+    parser.add_argument("--device", default="cpu", type=str)
+    args = parser.parse_args()
+    main(args)
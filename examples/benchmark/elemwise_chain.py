@@ -0,0 +1,33 @@
+import runtime_path  # isort:skip
+
+import argparse
+import time
+
+import numpy as np
+
+from core.tensor import Tensor
+
+
+def main(args):
+    shape = (args.size, args.size)
+    grad, m, v = [Tensor(np.abs(np.random.normal(0, 1, shape))).to(args.device) for _ in range(3)]
+    def adam_like():
+        # memory bandwidth bound chain of elemwise ops, fused into one expression in lazy mode
+        m_ = m * 0.9 + grad * 0.1
+        v_ = v * 0.999 + grad * grad * 0.001
+        step = (m_ / 0.1) / ((v_ / 0.001) ** 0.5 + 1e-8) * -0.001
+        return step.numpy()
+    adam_like()
+    cnt, ts = 0, time.monotonic()
+    while time.monotonic() - ts < args.duration:
+        adam_like()
+        cnt += 1
+    print(f"adam_like {shape}: {(time.monotonic() - ts) / cnt * 1e3:.2f} ms/iter")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", default=2048, type=int)
+    parser.add_argument("--duration", default=3.0, type=float)
+    parser.add_argument("--device", default="cpu", type=str)
+    args = parser.parse_args()
+    main(args)
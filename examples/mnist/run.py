@@ -11,9 +11,14 @@ import numpy as np
 
 from core.nn.net import SequentialNet
 from core.nn.layers import Dense, ReLU
-from core.nn.loss import SoftmaxCrossEntropyLoss
+from core.nn.loss import SparseSoftmaxCrossEntropyLoss
 from core.nn.optimizer import Adam, SGD
 from core.tensor import Tensor
+from core.dtype import int32
+from core.autograd.ops import no_grad
+from core.autograd.profiler import profile
+from core.jit.capture import capture
+from core.backend.numpy import pool
 from utils.data_iterator import BatchIterator
 from utils.downloader import download_url
 from utils.evaluator import AccEvaluator
@@ -21,9 +26,6 @@ from utils.helper import kernelstat
 from env import LAZY, BACKEND
 
 
-def get_one_hot(targets, nb_classes):
-    return np.eye(nb_classes)[np.array(targets).reshape(-1)]
-
 def prepare_dataset(data_dir):
     url = "https://raw.githubusercontent.com/mnielsen/neural-networks-and-deep-learning/master/data/mnist.pkl.gz"
     save_path = os.path.join(data_dir, url.split("/")[-1])
@@ -52,9 +54,8 @@ def main(args):
     train_set, valid_set, test_set = prepare_dataset(args.data_dir)
     train_x, train_y = train_set
     test_x, test_y = test_set
-    train_y = get_one_hot(train_y, 10)
     train_x = Tensor(train_x)
-    train_y = Tensor(train_y)
+    train_y = Tensor(train_y, dtype=int32)
     test_x = Tensor(test_x).to(args.device)
     test_y = Tensor(test_y)
 
@@ -65,14 +66,39 @@ def main(args):
             Dense(32), ReLU(),
             Dense(10)).to(args.device)
     optim = Adam(net.get_parameters(), lr=args.lr)
-    loss_fn = SoftmaxCrossEntropyLoss()
+    loss_fn = SparseSoftmaxCrossEntropyLoss()
 
     iterator = BatchIterator(batch_size=args.batch_size)
     evaluator = AccEvaluator()
     from core.backend.opencl import cl
+
+    def train_step(x, y):
+        net.zero_grad()
+        loss = loss_fn(net.forward(x), y)
+        loss.backward()
+        optim.step()
+        return loss
+
+    assert not args.capture or args.device == "cpu", "capture only supports cpu device"
+    graph = None
     for epoch in range(args.num_ep):
         t_start = time.monotonic()
         for batch in iterator(train_x, train_y):
+            if args.profile_ops:
+                with profile(record_callsite=True) as prof:
+                    loss = train_step(batch.inputs.to(args.device), batch.targets.to(args.device))
+                    loss.numpy()
+                print(prof.table())
+                prof.export_chrome_trace(args.trace_file)
+                print(f"chrome trace saved to {args.trace_file}")
+                sys.exit()
+            if args.capture and optim.t and len(batch.inputs) == args.batch_size:
+                # NOTE: capture after one eager step, batches of other sizes fall back to eager
+                if graph is None:
+                    graph = capture(train_step, batch.inputs, batch.targets)
+                else:
+                    graph.replay(batch.inputs, batch.targets)
+                continue
             net.zero_grad()
             x, y = batch.inputs.to(args.device), batch.targets.to(args.device)
             pred = net.forward(x)
@@ -95,8 +121,11 @@ def main(args):
 
         print(f"Epoch {epoch} time cost: {time.monotonic() - t_start:.4f}")
         print(f"opencl info: {cl.info}")
+        print(f"numpy pool info: {pool.info} hit rate: {pool.hit_rate:.3f}")
+        pool.trim()
         if args.eval:
-            test_pred = net.forward(test_x).numpy()
+            with no_grad():
+                test_pred = net.forward(test_x).numpy()
             test_pred_idx = np.argmax(test_pred, axis=1)
             test_y_idx = test_y.numpy()
             print(evaluator.evaluate(test_pred_idx, test_y_idx))
@@ -114,7 +143,10 @@ if __name__ == "__main__":
 
     parser.add_argument("--profile_forward", default=0, type=int)
     parser.add_argument("--profile_backward", default=0, type=int)
+    parser.add_argument("--profile_ops", default=0, type=int)
+    parser.add_argument("--trace_file", default="trace.json", type=str)
     parser.add_argument("--eval", default=0, type=int)
+    parser.add_argument("--capture", default=0, type=int)
     default_device = "gpu" if BACKEND in ("opencl", "cuda") else "cpu"
     parser.add_argument("--device", default=default_device, type=str)
     args = parser.parse_args()
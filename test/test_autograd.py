@@ -1,9 +1,13 @@
 import runtime_path  # isort:skip
 
+import sys
+
 import numpy as np
+import pytest
 
+import core.autograd.ops as ops
 from core.tensor import Tensor
-from env import BACKEND, LAZY
+from env import BACKEND, LAZY, PROFILE
 
 def test_add_op():
     devices = ("gpu", "cpu")
@@ -260,3 +264,210 @@ def test_minimal():
         assert np.allclose(loss.numpy(), loss_final, rtol=1e-3)
         assert np.allclose(w.numpy(), w_final, rtol=1e-3)
         assert np.allclose(b.numpy(), b_final, rtol=1e-3)
+
+def test_backward_shared_nodes():
+    devices = ("gpu", "cpu")
+    for device in devices:
+        t1 = Tensor([1, 3, 5], requires_grad=True).to(device)
+        t2 = t1 * 2
+        t3 = t2 * t2 + t2.exp()
+        t3.backward([1, 1, 1])
+        data = np.array([1, 3, 5])
+        assert np.allclose(t1.grad.numpy(), 8 * data + 2 * np.exp(2 * data), rtol=1e-4)
+
+def test_backward_deep_graph():
+    devices = ("gpu", "cpu")
+    for device in devices:
+        t1 = Tensor([1, 3, 5], requires_grad=True).to(device)
+        t2 = t1
+        for _ in range(sys.getrecursionlimit() * 2):
+            t2 = t2 + 1
+        t2.backward([1, 2, 3])
+        assert np.allclose(t1.grad.numpy(), [1, 2, 3])
+
+def test_no_grad():
+    from core.autograd.ops import no_grad, inference_mode
+    devices = ("gpu", "cpu")
+    for device in devices:
+        t1 = Tensor([1, 3, 5], requires_grad=True).to(device)
+        with no_grad():
+            t2 = t1 * 2 + 1
+        assert np.allclose(t2.numpy(), [3, 7, 11])
+        assert not t2.requires_grad and t2.dependency == () and t2.name is None
+
+        @inference_mode()
+        def forward(x):
+            return (x * x).sum()
+        t3 = forward(t1)
+        assert not t3.requires_grad and t3.numpy() == 35
+
+        @no_grad
+        def forward(x):
+            return (x * x).sum()
+        t3 = forward(t1)
+        assert not t3.requires_grad and t3.numpy() == 35
+
+        t4 = t1 * 2
+        assert t4.requires_grad
+        t4.backward([1, 1, 1])
+        assert np.allclose(t1.grad.numpy(), [2, 2, 2])
+
+def test_dispatch_fast_path():
+    devices = ("gpu", "cpu")
+    for device in devices:
+        t1 = Tensor([1, 3, 5], requires_grad=True).to(device)
+        t2 = Tensor([2, 2, 2]).to(device)
+        t3 = t2 * 2.0
+        assert not t3.requires_grad and t3.dependency == () and t3.name is None
+        # scalar arrays are shared per device/dtype/value, the tensors are not
+        s1, s2 = t1.astensor(2.0), t2.astensor(2.0)
+        assert s1 is not s2 and s1.array is s2.array and s1.array is not t1.astensor(2).array
+        if device == "cpu": assert not s1.array.data.flags.writeable
+        assert np.isnan(t1.astensor(float("nan")).numpy())
+        assert t1.astensor(0.0).array is not t1.astensor(-0.0).array
+        with np.errstate(divide="ignore"):
+            assert np.all(np.isneginf((1.0 / (t2 * -0.0)).numpy()))
+        t4 = t1 * t3 + 1
+        assert t4.name.startswith("add_")
+        t4.backward([1, 1, 1])
+        assert np.allclose(t4.numpy(), [5, 13, 21])
+        assert np.allclose(t1.grad.numpy(), [4, 4, 4])
+
+def test_backward_release_graph():
+    devices = ("gpu", "cpu")
+    for device in devices:
+        t1 = Tensor([1, 3, 5], requires_grad=True).to(device)
+        t2 = t1 * 2
+        t3 = t2 * t2
+        t3.backward([1, 1, 1])
+        assert t2.grad is None and t3.grad is None
+        assert t2.dependency == () and t3.dependency == ()
+        assert np.allclose(t1.grad.numpy(), [8, 24, 40])
+        with pytest.raises(AssertionError):
+            t3.backward([1, 1, 1])
+
+        t1 = Tensor([1, 3, 5], requires_grad=True).to(device)
+        t2 = t1 * 2
+        t2.retain_grad()
+        t3 = t2 * t2
+        t3.backward([1, 1, 1], retain_graph=True)
+        assert np.allclose(t2.grad.numpy(), [4, 12, 20])
+        t3.backward([1, 1, 1])
+        assert np.allclose(t2.grad.numpy(), [8, 24, 40])
+        assert np.allclose(t1.grad.numpy(), [16, 48, 80])
+
+def test_checkpoint_sequential_net():
+    from core.nn.layers import Dense, ReLU
+    from core.nn.net import SequentialNet
+    devices = ("gpu", "cpu")
+    for device in devices:
+        x = Tensor(np.random.normal(0, 1, (8, 16))).to(device)
+        net = SequentialNet(Dense(32), ReLU(), Dense(32), ReLU(), Dense(16), ReLU(), Dense(4)).to(device)
+        net.forward(x).sum().backward()
+        grads = [{k: v.grad.numpy() for k, v in param.items()} for param in net.get_parameters() if param]
+
+        for segments in (2, 3, 7):
+            net.zero_grad()
+            net.checkpoint_segments = segments
+            pred = net.forward(x)
+            assert len(pred.dependency) == 2  # only the last segment keeps its graph
+            pred.sum().backward()
+            for param, grad in zip([p for p in net.get_parameters() if p], grads):
+                for k, v in param.items():
+                    assert np.allclose(v.grad.numpy(), grad[k], rtol=1e-4, atol=1e-4)
+
+def test_softmax_ops():
+    def log_softmax(x):
+        x = x - x.max(axis=-1, keepdims=True)
+        return x - np.log(np.exp(x).sum(axis=-1, keepdims=True))
+    data = np.random.normal(0, 3, (4, 10)).astype(np.float32)
+    labels = np.eye(10)[np.random.randint(0, 10, 4)].astype(np.float32)
+    grad = np.random.normal(0, 1, (4, 10)).astype(np.float32)
+    p = np.exp(log_softmax(data))
+    devices = ("gpu", "cpu")
+    for device in devices:
+        t1 = Tensor(data, requires_grad=True).to(device)
+        t2 = t1.softmax()
+        assert np.allclose(t2.numpy(), p, rtol=1e-4, atol=1e-6)
+        t2.backward(grad)
+        assert np.allclose(t1.grad.numpy(), p * (grad - (grad * p).sum(axis=-1, keepdims=True)), atol=1e-5)
+
+        t1 = Tensor(data, requires_grad=True).to(device)
+        t2 = t1.log_softmax()
+        assert np.allclose(t2.numpy(), log_softmax(data), rtol=1e-4, atol=1e-6)
+        t2.backward(grad)
+        assert np.allclose(t1.grad.numpy(), grad - p * grad.sum(axis=-1, keepdims=True), atol=1e-5)
+
+        t1 = Tensor(data, requires_grad=True).to(device)
+        t2 = Tensor(labels).to(device)
+        t3 = ops.softmax_cross_entropy(t1, t2)
+        assert np.allclose(t3.numpy(), -(labels * log_softmax(data)).sum(axis=-1), rtol=1e-4)
+        t3.sum().backward()
+        assert np.allclose(t1.grad.numpy(), p - labels, atol=1e-5)
+
+def test_sparse_softmax_cross_entropy_ops():
+    from core.dtype import int32
+    from core.nn.loss import SoftmaxCrossEntropyLoss, SparseSoftmaxCrossEntropyLoss
+    data = np.random.normal(0, 3, (8, 10)).astype(np.float32)
+    labels = np.random.randint(0, 10, 8)
+    devices = ("gpu", "cpu")
+    for device in devices:
+        t1 = Tensor(data, requires_grad=True).to(device)
+        t2 = Tensor(labels, dtype=int32).to(device)
+        assert t2.dtype == int32 and np.all(t2.numpy() == labels)
+        loss = SparseSoftmaxCrossEntropyLoss()(t1, t2)
+        loss.backward()
+
+        t3 = Tensor(data, requires_grad=True).to(device)
+        t4 = Tensor(np.eye(10)[labels]).to(device)
+        loss_ = SoftmaxCrossEntropyLoss()(t3, t4)
+        loss_.backward()
+        assert np.allclose(loss.numpy(), loss_.numpy(), rtol=1e-4)
+        assert np.allclose(t1.grad.numpy(), t3.grad.numpy(), atol=1e-6)
+
+def test_unbroadcast():
+    from core.autograd.ops import unbroadcast_axes
+    assert unbroadcast_axes((4, 2, 3), (3,)) == (0, 1)
+    assert unbroadcast_axes((4, 2, 3), (2, 1)) == (0, 2)
+    assert unbroadcast_axes((4, 1, 3), (1, 1, 3)) == (0,)
+    devices = ("gpu", "cpu")
+    for device in devices:
+        for shape1, shape2 in (((2, 3), (3,)), ((2, 3), (1, 3)), ((4, 2, 3), (2, 1)), ((4, 1, 3), (1, 5, 1))):
+            data1, data2 = np.random.normal(0, 1, shape1), np.random.normal(0, 1, shape2)
+            t1 = Tensor(data1, requires_grad=True).to(device)
+            t2 = Tensor(data2, requires_grad=True).to(device)
+            (t1 * t2).sum().backward()
+            grad_shape = np.broadcast(data1, data2).shape
+            grad1 = np.broadcast_to(data2, grad_shape).reshape((-1, *shape1)).sum(axis=0)
+            grad2 = np.broadcast_to(data1, grad_shape).reshape((-1, *grad_shape[-len(shape2):])).sum(axis=0)
+            grad2 = grad2.sum(axis=tuple(i for i, s in enumerate(shape2) if s == 1), keepdims=True)
+            assert np.allclose(t1.grad.numpy(), grad1, rtol=1e-4) and t1.grad.shape == shape1
+            assert np.allclose(t2.grad.numpy(), grad2, rtol=1e-4) and t2.grad.shape == shape2
+
+def test_profiler(tmp_path):
+    import json
+    from core.autograd.profiler import profile
+    devices = ("gpu", "cpu")
+    for device in devices:
+        t1 = Tensor(np.ones((4, 8)), requires_grad=True).to(device)
+        t2 = Tensor(np.ones((8, 2)), requires_grad=True).to(device)
+        with profile() as prof:
+            t3 = (t1 @ t2).relu().sum()
+            t3.backward()
+        assert profile.current is None
+        assert {k: s.count for k, s in prof.stats.items() if s.count} == {"matmul": 1, "relu": 1, "sum": 1}
+        matmul = prof.stats["matmul"]
+        assert matmul.out_bytes == 4 * 2 * 4 and matmul.retained_bytes == (4 * 8 + 8 * 2) * 4
+        assert matmul.fwd_time > 0 and matmul.bwd_time > 0
+        assert np.allclose(t1.grad.numpy(), np.full((4, 8), 2.0))
+        assert all(op in prof.table() for op in ("matmul", "relu", "sum"))
+        prof.export_chrome_trace(tmp_path / "trace.json")
+        events = json.load(open(tmp_path / "trace.json"))["traceEvents"]
+        assert {e["cat"] for e in events} == {"forward", "backward"}
+        if device == "gpu" and not PROFILE:
+            # NOTE: only the launches within a profile run on the profiling queue
+            from core.backend.opencl import cl, PROFILING_ENABLE
+            assert not cl.queue.properties & PROFILING_ENABLE
+            with profile():
+                assert cl.queue.properties & PROFILING_ENABLE
+                assert LAZY or prof.stats["matmul"].device_time > 0
@@ -445,3 +445,243 @@ def test_graph_optimizer_elemwise_processing_fusion():
     #aa = d.numpy()
     #bb = a_np @ b_np + np.exp(c_np)
     assert np.allclose(d.numpy(), a_np @ b_np + np.exp(c_np), rtol=1e-3)
+
+def test_graph_optimizer_elemwise_reduce_fusion(monkeypatch):
+    if not LAZY: return
+    import core.jit.graph as graph
+    monkeypatch.setattr(graph, "OPT_ELEMWISE_FUSION", 1)
+    monkeypatch.setattr(graph, "OPT_ELEMWISE_REDUCE_FUSION", 1)
+    a_np, l_np = np.random.normal(0, 1, (32, 10)), np.random.uniform(0, 1, (32, 10))
+    m_np = a_np.max(axis=1, keepdims=True)
+    a, l, m = Tensor(a_np).to("gpu"), Tensor(l_np).to("gpu"), Tensor(m_np).to("gpu")
+
+    # elemwise producer and consumers of a reduction run in the reduce kernel
+    kernelstat.reset()
+    c = ((a - m).exp().sum(axis=1) / 32.0).log() * -1.0
+    c.array.eager()
+    assert kernelstat.total() == 1 and kernelstat.get(ReduceOps)["SUM"] == 1
+    check_tensor(c, -np.log(np.exp(a_np - m_np).sum(axis=1) / 32.0), rtol=1e-3)
+
+    # epilogue with a non-lazy operand, multiple axes and a strided view
+    s = m.sum(axis=0, keepdims=True)
+    s.array.eager()
+    kernelstat.reset()
+    c = (a * l).mean(axis=(0, 1), keepdims=True) + s
+    c.array.eager()
+    assert kernelstat.total() == 1
+    check_tensor(c, (a_np * l_np).mean(keepdims=True) + m_np.sum(keepdims=True), rtol=1e-3)
+    c = (a.T.exp() * l.T).argmax(axis=1)
+    check_tensor(c, (np.exp(a_np.T) * l_np.T).argmax(axis=1).astype(np.float32))
+
+    # elemwise result used by another node, do not fuse
+    d = (a * l)
+    c = d.sum(axis=1) + d.max(axis=1)
+    check_tensor(c, (a_np * l_np).sum(axis=1) + (a_np * l_np).max(axis=1), rtol=1e-3)
+
+def test_graph_cache(monkeypatch):
+    if not LAZY: return
+    import core.jit.graph as graph
+    monkeypatch.setattr(graph, "graph_cache", graph.GraphCache(size=2))
+    a_np, b_np = np.random.normal(0, 1, (16, 8)), np.random.normal(0, 1, (8, 4))
+    b = Tensor(b_np).to("gpu")
+    def run(a_np, scale):
+        a = Tensor(a_np).to("gpu")
+        c = ((a * scale + 1.0) @ b).exp().sum(axis=1) / scale
+        check_tensor(c, np.exp((a_np * scale + 1.0) @ b_np).sum(axis=1) / scale, rtol=1e-3)
+    # the same structure with new data reuses the optimized graph
+    for i in range(3):
+        run(a_np + i, 2.0)
+    assert graph.graph_cache.info == {"hits": 2, "misses": 1}
+    # new constants, shapes or strides are new keys
+    run(a_np, 3.0)
+    run(np.random.normal(0, 1, (5, 8)), 2.0)
+    run(a_np.T.copy().T, 2.0)
+    assert len(graph.graph_cache.plans) == 2
+    run(a_np, 3.0)
+    # the key holds every attribute a pass reads, the offset of a view and the constant values read by the rewrites
+    a = Tensor(a_np).to("gpu")
+    key = lambda c: graph.GraphOptimizer(c.array)._signature(graph.Graph(c.array).nodes)
+    for flag in ("OPT_ALGEBRAIC_SIMPLIFICATION", "OPT_CSE", "OPT_CONSTANT_FOLDING"):
+        monkeypatch.setattr(graph, flag, 0)
+    assert key(a[0:2] + 1.0) != key(a[2:4] + 1.0)
+    assert key(a * 2.0) == key(a * 3.0)
+    monkeypatch.setattr(graph, "OPT_ALGEBRAIC_SIMPLIFICATION", 1)
+    assert key(a * 2.0) != key(a * 3.0)
+
+def test_graph_optimizer_deep_graph(monkeypatch):
+    if not LAZY: return
+    import sys
+    import core.jit.graph as graph
+    # NOTE: fused, the chain would be a single expression nested as deep as the graph
+    monkeypatch.setattr(graph, "OPT_ELEMWISE_FUSION", 0)
+    monkeypatch.setattr(graph, "OPT_ELEMWISE_REDUCE_FUSION", 0)
+    a_np = np.random.normal(0, 1, (4, 4)).astype(np.float32)
+    a, c, c_np = Tensor(a_np).to("gpu"), Tensor(a_np).to("gpu"), a_np.copy()
+    for i in range(sys.getrecursionlimit() * 2):
+        c = c * 0.5 + a
+        c_np = c_np * 0.5 + a_np
+    # the passes and the evaluation walk the graph without recursion
+    g = graph.Graph(c.array)
+    assert len(g.nodes) == len(set(map(id, g.nodes))) and g.nodes[-1] is c.array
+    assert all(g.outdegree[id(n)] > 0 for n in g.nodes[:-1])
+    check_tensor(c, c_np, rtol=1e-3)
+
+def test_graph_optimizer_many_names(monkeypatch):
+    if not LAZY: return
+    import core.jit.graph as graph
+    monkeypatch.setattr(graph, "OPT_ELEMWISE_FUSION", 0)
+    monkeypatch.setattr(graph, "OPT_ELEMWISE_REDUCE_FUSION", 0)
+    a_np = np.random.normal(0, 1, (4, 4)).astype(np.float32)
+    a, c, c_np = Tensor(a_np).to("gpu"), Tensor(a_np).to("gpu"), a_np.copy()
+    # more operands than the 26^3 names of a fixed pool
+    for i in range(6000):
+        c = c * 0.5 + a
+        c_np = c_np * 0.5 + a_np
+    assert len(graph.Graph(c.array).nodes) > 26 ** 3
+    check_tensor(c, c_np, rtol=1e-3)
+
+def test_graph_optimizer_cse(monkeypatch):
+    if not LAZY: return
+    import core.jit.graph as graph
+    from collections import defaultdict
+    monkeypatch.setattr(graph, "OPT_CSE", 1)
+    monkeypatch.setattr(graph.GraphOptimizer, "info", {"cse_nodes": 0, "cse_kernels": 0, "simplified": defaultdict(int)})
+    a_np, b_np = np.random.normal(0, 1, (8, 5)), np.random.normal(0, 1, (5, 3))
+    a, b = Tensor(a_np).to("gpu"), Tensor(b_np).to("gpu")
+    # duplicated matmul (with the reshapes of its eager operands), exp, mul by the same constant and sum
+    kernelstat.reset()
+    c = (a @ b).exp() + (a @ b).exp() + (a * 2.0).sum() * (a * 2.0).sum()
+    c.array.eager()
+    assert kernelstat.get(ProcessingOps)["MATMUL"] == 1 and kernelstat.get(ReduceOps)["SUM"] == 1
+    assert graph.GraphOptimizer.info["cse_kernels"] == 4
+    check_tensor(c, 2 * np.exp(a_np @ b_np) + (a_np * 2.0).sum() ** 2, rtol=1e-3)
+    # different args or operands are kept apart
+    c = a.sum(axis=0) + a.sum(axis=0) * a.max(axis=0) - a.T.sum(axis=1)
+    check_tensor(c, a_np.sum(axis=0) + a_np.sum(axis=0) * a_np.max(axis=0) - a_np.T.sum(axis=1), rtol=1e-3, atol=1e-5)
+    # a plan merging equal constants or views is not replayed on a graph where they differ
+    monkeypatch.setattr(graph, "graph_cache", graph.GraphCache(size=8))
+    # NOTE: 2 and 2.0 are separate constant nodes of the same value
+    check_tensor((a + 1.0) * 2 + (a + 1.0) * 2.0, (a_np + 1.0) * 4.0, rtol=1e-3)
+    check_tensor((a + 1.0) * 2 + (a + 1.0) * 3.0, (a_np + 1.0) * 5.0, rtol=1e-3)
+    check_tensor((a + 1.0) * 2.0 + (a + 1.0) * 2.0, (a_np + 1.0) * 4.0, rtol=1e-3)
+    check_tensor((a + 1.0) * 2.0 + (a + 1.0) * 3.0, (a_np + 1.0) * 5.0, rtol=1e-3)
+    check_tensor(a.T[0:2] * 2.0 + a.T[0:2], a_np.T[0:2] * 3.0, rtol=1e-3)
+    check_tensor(a.T[0:2] * 2.0 + a.T[2:4], a_np.T[0:2] * 2.0 + a_np.T[2:4], rtol=1e-3)
+    assert graph.graph_cache.info["hits"] == 1  # NOTE: 2.0 + 3.0 after 2 + 3.0
+    # 0.0 and -0.0 are not merged
+    with np.errstate(divide="ignore", invalid="ignore"):
+        assert np.all(np.isnan((1.0 / (a * 0.0) + 1.0 / (a * -0.0)).numpy()))
+    # gradients of a graph with merged nodes
+    w = Tensor(np.random.normal(0, 1, (5, 3)), requires_grad=True).to("gpu")
+    loss = ((a @ w) * (a @ w)).sum() + (a @ w).max()
+    loss.backward()
+    w_np = w.numpy()
+    grad_np = 2 * a_np.T @ (a_np @ w_np) + a_np.T @ ((a_np @ w_np) == (a_np @ w_np).max())
+    check_tensor(w.grad, grad_np, rtol=1e-3, atol=1e-4)
+
+def test_graph_optimizer_algebraic_simplification(monkeypatch):
+    if not LAZY: return
+    import core.jit.graph as graph
+    from collections import defaultdict
+    monkeypatch.setattr(graph, "OPT_ALGEBRAIC_SIMPLIFICATION", 1)
+    monkeypatch.setattr(graph.GraphOptimizer, "info", {"cse_nodes": 0, "cse_kernels": 0, "simplified": defaultdict(int)})
+    a_np = np.random.normal(0, 1, (4, 5))
+    a = Tensor(a_np).to("gpu")
+    b = (a + 2.0).array
+    # each rule on its own, a rule forwards the users to a node with the same layout or rewrites the view
+    rules = graph.SIMPLIFY_RULES
+    for name, node in (("mul_one", b * 1.0), ("mul_one", 1.0 * b), ("add_zero", b + 0.0), ("sub_zero", b - 0.0),
+                       ("div_one", b / 1.0), ("neg_neg", -(-b)), ("exp_log", b.log().exp()),
+                       ("noop_contiguous", b.contiguous()), ("identity_view", b.expand((4, 5))),
+                       ("identity_view", b.reshape((4, 5))), ("identity_view", b.permute((0, 1)))):
+        assert rules[name](node) is b, name
+    for name, node in (("mul_one", b * 2.0), ("sub_zero", 0.0 - b), ("neg_neg", -b), ("exp_log", b.exp().log()),
+                       ("noop_contiguous", b.T.contiguous()), ("mul_one", b.reshape((4, 1, 5)) * np.ones((4, 3, 5))),
+                       ("identity_view", b.T)):
+        assert rules[name](node) is None, name
+    assert rules["permute_permute"](b.T.T).args == {"axes": (0, 1)}
+    assert rules["reshape_reshape"](b.reshape((20,)).reshape((2, 10))).operands["A"] is b
+    assert rules["expand_expand"](b.reshape((4, 1, 5)).expand((4, 3, 5)).expand((4, 3, 5))).args == {"shape": (4, 3, 5)}
+    # the chain is computed by the kernels of its first and last nodes
+    kernelstat.reset()
+    c = ((-(-b)).log().exp() * 1.0 + 0.0).T.T.reshape((20,)).reshape((4, 5)).contiguous() / 1.0 - 1.0
+    c.eager()
+    assert kernelstat.total() == (1 if graph.OPT_ELEMWISE_FUSION else 2)
+    assert set(graph.GraphOptimizer.info["simplified"]) == {"neg_neg", "exp_log", "mul_one", "add_zero", "div_one",
+        "permute_permute", "reshape_reshape", "identity_view", "noop_contiguous"}
+    check_tensor(Tensor(c), a_np + 1.0, rtol=1e-3)
+    # a plan of a rule matching a constant is not replayed on a graph with another constant
+    monkeypatch.setattr(graph, "graph_cache", graph.GraphCache(size=8))
+    check_tensor(((a + 0.5) * 1.0).exp(), np.exp(a_np + 0.5), rtol=1e-3)
+    check_tensor(((a + 0.5) * 2.0).exp(), np.exp((a_np + 0.5) * 2.0), rtol=1e-3)
+    assert graph.graph_cache.info["hits"] == 0
+    # gradients of a simplified graph
+    w = Tensor(np.random.normal(0, 1, (5, 3)), requires_grad=True).to("gpu")
+    loss = (-(-((a @ w) * 1.0)).T.T).sum()
+    loss.backward()
+    check_tensor(w.grad, a_np.T @ np.ones((4, 3)), rtol=1e-3, atol=1e-4)
+
+def test_numpy_lazy_elemwise(monkeypatch):
+    import core.backend.numpy as npbackend
+    from core.backend.numpy import NPArray
+    monkeypatch.setattr(npbackend, "LAZY", True)
+    # large enough to be evaluated in chunks, over the flattened elements and over the rows
+    a_np, b_np = np.abs(np.random.normal(0, 1, (2, 300, 100))), np.random.normal(0, 1, (300, 1))
+    a, b = Tensor(a_np), Tensor(b_np)
+    c = ((a * 0.9 + (a + 1).log()) ** 0.5).relu()
+    d = (c - b).exp() / (c + 1)
+    assert c.array.is_lazy and d.array.is_lazy
+    c_np = np.maximum((a_np * 0.9 + np.log(a_np + 1)) ** 0.5, 0)
+    check_tensor(d, np.exp(c_np - b_np) / (c_np + 1), rtol=1e-3)
+    # non-elemwise ops evaluate their lazy inputs
+    e = (a + 1).sum(axis=0)
+    assert not e.array.is_lazy
+    check_tensor(e, (a_np + 1).sum(axis=0), rtol=1e-3)
+    check_tensor(Tensor(NPArray(2.0)) * 3.0 + 1.0, np.array(7.0))
+    # an op with an out writes into it, in place ops keep their array
+    x, y = NPArray(a_np), NPArray(b_np)
+    out = NPArray.empty(a_np.shape)
+    assert (x * 2.0).exp(out=out) is out and np.allclose(out.data, np.exp(a_np * 2.0), rtol=1e-4)
+    x += y
+    assert not x.is_lazy and np.allclose(x.data, a_np + b_np, atol=1e-5)
+    assert (x + 1.0).size == x.size == a_np.size * 4
+
+def test_capture_replay():
+    import core.backend.numpy as npbackend
+    if npbackend.LAZY: return  # NOTE: capture records the eager numpy ops
+    from core.jit.capture import capture
+    from core.nn.layers import Dense, ReLU
+    from core.nn.loss import SoftmaxCrossEntropyLoss
+    from core.nn.net import SequentialNet
+    from core.nn.optimizer import Adam, RMSProp, SGD
+
+    x_np = np.random.normal(0, 1, (6, 32, 16)).astype(np.float32)
+    y_np = np.eye(4)[np.random.randint(0, 4, (6, 32))].astype(np.float32)
+    for optim_cls, kwargs in ((Adam, {}), (SGD, {"momentum": 0.9}), (RMSProp, {"momentum": 0.9})):
+        def build():
+            np.random.seed(0)
+            net = SequentialNet(Dense(32), ReLU(), Dense(4))
+            net.forward(Tensor(x_np[0]))
+            return net, optim_cls(net.get_parameters(), lr=1e-2, **kwargs)
+
+        def train_step(net, optim, x, y):
+            net.zero_grad()
+            loss = SoftmaxCrossEntropyLoss()(net.forward(x), y)
+            loss.backward()
+            optim.step()
+            return loss
+
+        net, optim = build()
+        losses = [train_step(net, optim, Tensor(x), Tensor(y)).numpy() for x, y in zip(x_np, y_np)]
+
+        net_, optim_ = build()
+        train_step(net_, optim_, Tensor(x_np[0]), Tensor(y_np[0]))
+        x, y = Tensor(x_np[1]), Tensor(y_np[1])
+        graph = capture(lambda x, y: train_step(net_, optim_, x, y), x, y)
+        losses_ = [losses[0], graph.outputs.numpy()]
+        for x, y in zip(x_np[2:], y_np[2:]):
+            losses_.append(graph.replay(x, y).numpy())
+        assert np.allclose(losses, losses_, rtol=1e-4)
+        for param, param_ in zip(net.get_parameters(), net_.get_parameters()):
+            for k in param:
+                check_tensor(param_[k], param[k].numpy(), rtol=1e-4)
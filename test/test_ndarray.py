@@ -199,3 +199,253 @@ def test_matmul_op():
     nparr2 = np.ascontiguousarray(np.broadcast_to(nparr2, (5, 3)))
     check_array(arr1@arr2, nparr1@nparr2, rtol=1e-3)
 
+def test_matmul_trans():
+    from core.backend.numpy import NPArray
+    rnd = lambda s: np.random.randint(0, 10, s).astype(np.float32)
+    swap = lambda a: np.swapaxes(a, -1, -2) if a.ndim > 1 else a
+    shape_pairs = [
+        [(4, 5), (5, 3), False, True],
+        [(4, 5), (5, 3), True, False],
+        [(4, 5), (5, 3), True, True],
+        [(5,), (5, 3), False, True],
+        [(4, 5), (5,), True, False],
+        [(2, 4, 5), (2, 5, 3), True, True],
+        [(2, 4, 5), (5, 3), False, True],
+        [(2, 3, 4, 5), (1, 1, 5, 3), True, False],
+        [(1, 64, 32), (1, 32, 128), True, True]
+    ]
+    for s1, s2, trans_a, trans_b in shape_pairs:
+        nparr1, nparr2 = rnd(s1), rnd(s2)
+        # operands stored transposed, e.g. the weight of a Dense layer in the backward pass
+        if trans_a: nparr1 = np.ascontiguousarray(swap(nparr1))
+        if trans_b: nparr2 = np.ascontiguousarray(swap(nparr2))
+        expect = (swap(nparr1) if trans_a else nparr1) @ (swap(nparr2) if trans_b else nparr2)
+        for array_cls in (CLArray, NPArray):
+            arr = array_cls(nparr1).matmul(array_cls(nparr2), trans_a=trans_a, trans_b=trans_b)
+            check_array(arr, expect, rtol=1e-3)
+
+
+def test_softmax_op():
+    def log_softmax(x):
+        x = x - x.max(axis=-1, keepdims=True)
+        return x - np.log(np.exp(x).sum(axis=-1, keepdims=True))
+    for shape in [(1,), (4, 10), (3, 2**10+3), (2, 3, 5)]:
+        nparr, nplabels = rnd(shape) * 10, np.abs(rnd(shape))
+        arr, labels = CLArray(nparr), CLArray(nplabels)
+        check_array(arr.log_softmax(), log_softmax(nparr), atol=1e-5)
+        check_array(arr.softmax(), np.exp(log_softmax(nparr)), atol=1e-5)
+        check_array(arr.softmax_cross_entropy(labels), -(nplabels * log_softmax(nparr)).sum(axis=-1), rtol=1e-3)
+    # non-contiguous input
+    nparr = rnd((10, 4))
+    arr = CLArray(nparr).T
+    check_array(arr.softmax(), np.exp(log_softmax(nparr.T)), atol=1e-5, ignore=("stride", "contig"))
+
+def test_sparse_softmax_cross_entropy_op():
+    for shape in [(1, 10), (4, 10), (3, 2**10+3)]:
+        nparr = rnd(shape) * 10
+        nplabels = np.random.randint(0, shape[1], shape[0]).astype(np.int32)
+        npgrad = rnd(shape[:1])
+        arr, labels, grad = CLArray(nparr), CLArray(nplabels, dtype=np.int32), CLArray(npgrad)
+        lse = np.log(np.exp(nparr - nparr.max(axis=1, keepdims=True)).sum(axis=1)) + nparr.max(axis=1)
+        rows = np.arange(shape[0])
+        check_array(arr.sparse_softmax_cross_entropy(labels), lse - nparr[rows, nplabels], atol=1e-4)
+        p = np.exp(nparr - lse[:, None])
+        p[rows, nplabels] -= 1.0
+        check_array(arr.sparse_softmax_cross_entropy_grad(labels, grad), p * npgrad[:, None], atol=1e-5)
+    # out of range labels give nan rows instead of reading out of bounds
+    arr, labels, grad = CLArray(rnd((3, 10))), CLArray(np.array([1, 10, -1], dtype=np.int32), dtype=np.int32), CLArray(rnd((3,)))
+    loss, dx = arr.sparse_softmax_cross_entropy(labels).numpy(), arr.sparse_softmax_cross_entropy_grad(labels, grad).numpy()
+    assert np.isfinite(loss[0]) and np.isnan(loss[1:]).all()
+    assert np.isfinite(dx[0]).all() and np.isnan(dx[1:]).all()
+    # the numpy backend agrees
+    from core.backend.numpy import NPArray
+    nparr, nplabels, npgrad = arr.numpy(), labels.numpy(), grad.numpy()
+    arr, labels, grad = NPArray(nparr), NPArray(nplabels, dtype=np.int32), NPArray(npgrad)
+    np_loss, np_dx = arr.sparse_softmax_cross_entropy(labels).numpy(), arr.sparse_softmax_cross_entropy_grad(labels, grad).numpy()
+    assert np.allclose(np_loss, loss, atol=1e-5, equal_nan=True) and np.allclose(np_dx, dx, atol=1e-5, equal_nan=True)
+
+def test_multi_axes_reduce_op():
+    shape = (2, 3, 4, 5)
+    nparr = rnd(shape)
+    for name in ("sum", "max"):
+        for axes in ((0, 1), (1, 2), (2, 3), (0, 2), (1, 3), (0, 1, 3), (-1, 0), (0, 1, 2, 3)):
+            for arr, nparr_ in ((CLArray(nparr), nparr), (CLArray(nparr).T, nparr.T)):
+                op1, op2 = getattr(arr, name), getattr(nparr_, name)
+                check_array(op1(axis=axes), op2(axis=axes), atol=1e-5, ignore=("stride", "contig"))
+                check_array(op1(axis=axes, keepdims=True), op2(axis=axes, keepdims=True), atol=1e-5, ignore=("stride", "contig"))
+
+def test_reduce_engine():
+    from core.backend.numpy import NPArray
+    from core.backend.opencl import cl
+    nparr = rnd((6, 40, 33))
+    views = [(CLArray(nparr), nparr), (CLArray(nparr).permute((2, 0, 1)), nparr.transpose(2, 0, 1)),
+             (CLArray(nparr)[1:5, 3:30], nparr[1:5, 3:30])]
+    for arr, nparr_ in views:
+        for name in ("sum", "max", "min", "mean", "argmax"):
+            axes_list = (None, 0, 1, -1) if name == "argmax" else (None, 1, (0, 2), (-1, 0, 1))
+            for axis in axes_list:
+                for keepdims in (False, True):
+                    expect = getattr(nparr_, name)(axis=axis, keepdims=keepdims).astype(np.float32)
+                    for arr_ in (arr, NPArray(nparr_)):
+                        out = getattr(arr_, name)(axis=axis, keepdims=keepdims)
+                        assert out.shape == expect.shape and np.allclose(out.numpy(), expect, atol=1e-4)
+    # views are reduced in place, a few outputs of a long reduction take a partial pass and a final pass
+    nparr = rnd((1 << 16, 4))
+    for name in ("sum", "argmax"):
+        arr = CLArray(nparr).T
+        cl.events = []
+        out = getattr(arr, name)(axis=1)
+        if out.is_lazy: out.eager()
+        launches, cl.events = len(cl.events), None
+        assert launches <= 2
+        check_array(out, getattr(nparr.T, name)(axis=1).astype(np.float32), atol=1e-2)
+
+def test_numpy_buffer_pool():
+    from core.backend.numpy import LAZY, NPArray, pool
+    if LAZY: return  # NOTE: lazy results take their buffers when evaluated
+    pool.trim()
+    a, b = NPArray(rnd((128, 256))), NPArray(rnd((128, 256)))
+    c = a + b
+    ptr = lambda arr: arr.data.__array_interface__["data"][0]
+    buf_id, hit = ptr(c), pool.info["hit"]
+    del c
+    d = a * b
+    # the buffer of a dead array is recycled for the next result of the same size
+    assert ptr(d) == buf_id and pool.info["hit"] == hit + 1
+    assert np.allclose(d.numpy(), a.numpy() * b.numpy())
+    # views (of views) that outlive the array keep its buffer out of the pool
+    view = d.reshape((256, 128)).permute((1, 0))[1:]
+    del d
+    e = a - b
+    assert ptr(e) != buf_id and np.allclose(view.numpy(), (a.numpy() * b.numpy()).reshape((256, 128)).T[1:])
+    del view
+    assert ptr(a / b) == buf_id
+    # small arrays are not pooled
+    assert (NPArray(rnd((4, 4))) + 1).data.base is None
+    del e
+    assert pool.info["bytes_held"] > 0 and 0 < pool.hit_rate < 1
+    pool.trim()
+    assert pool.info["bytes_held"] == 0 and not pool.free
+
+def test_numpy_chunk_executor(monkeypatch):
+    from core.backend.numpy import NPArray, executor
+    monkeypatch.setattr(executor, "num_threads", 4)
+    monkeypatch.setattr(executor, "threshold", 1024)
+    monkeypatch.setattr(executor, "reduce_grain", 256)
+    a, b, c = rnd((64, 32, 16)), rnd((32, 1)), rnd((1, 32, 16))
+    assert np.allclose((NPArray(a) + NPArray(b)).numpy(), a + b)
+    assert np.allclose(NPArray(a).drelu(NPArray(c)).numpy(), a * (c > 0))
+    out = NPArray.empty(a.shape)
+    NPArray(a).exp(out=out)
+    assert np.allclose(out.numpy(), np.exp(a))
+    # an input overlapping out with another layout is not split
+    sq = rnd((64, 64))
+    x, expect = NPArray(sq.copy()), sq + sq.T
+    x += x.permute((1, 0))
+    assert np.allclose(x.numpy(), expect)
+    for axis in (None, 0, 1, -1, (0, 2), (1, 2)):
+        for keepdims in (False, True):
+            assert np.allclose(NPArray(a).sum(axis=axis, keepdims=keepdims).numpy(),
+                               a.sum(axis=axis, keepdims=keepdims), atol=1e-4)
+            assert np.allclose(NPArray(a).max(axis=axis, keepdims=keepdims).numpy(), a.max(axis=axis, keepdims=keepdims))
+    # partial results are combined in a fixed order, the result does not depend on the thread count
+    big = rnd((1 << 16,))
+    s4 = NPArray(big).sum().numpy()
+    monkeypatch.setattr(executor, "num_threads", 3)
+    assert NPArray(big).sum().numpy() == s4
+
+def test_cl_binary_cache(tmp_path, monkeypatch):
+    from core.backend.opencl import CLContext, cl
+    monkeypatch.setattr(cl.cache, "cache_dir", str(tmp_path))
+    build = lambda i: CLContext.build.__wrapped__(cl, "fill", f"""
+    __kernel void fill(__global float *a) {{ a[get_global_id(0)] = {i}.0f; }}""")
+    build_cnt, cache_hit = cl.info["build_cnt"], cl.info["cache_hit"]
+    build(0)
+    assert cl.info["build_cnt"] == build_cnt + 1 and len(list(tmp_path.iterdir())) == 1
+    # a new process (i.e. an empty in-process cache) loads the binary instead of compiling the source
+    arr = CLArray.empty((8,))
+    build(0)((8,), None, arr.buffer)
+    assert cl.info["build_cnt"] == build_cnt + 1 and cl.info["cache_hit"] == cache_hit + 1
+    assert np.all(arr.numpy() == 0.0)
+    # the binaries are stored raw, a truncated or foreign file is a miss
+    path = next(tmp_path.iterdir())
+    binaries = cl.cache.get(path.stem)
+    assert all(isinstance(b, bytes) for b in binaries) and cl.cache.unpack(cl.cache.pack(binaries)) == binaries
+    data = path.read_bytes()
+    for bad in (data[:-1], data + b"\0", b"\x80\x04\x95garbage"):
+        path.write_bytes(bad)
+        assert cl.cache.get(path.stem) is None
+    path.write_bytes(data)
+    # the least recently used binaries are evicted once the cache is over its size limit
+    cl.cache.clear()
+    build(1)
+    monkeypatch.setattr(cl.cache, "max_bytes", 2 * next(tmp_path.iterdir()).stat().st_size)
+    for i in range(2, 5):
+        build(i)
+    assert len(list(tmp_path.iterdir())) == 2
+    build(4)
+    assert cl.info["cache_hit"] == cache_hit + 2
+
+def test_shape_polymorphic_kernels():
+    from core.backend.opencl import canonical_code, cl
+    # operands are renamed by their first appearance, independent of the graph names
+    assert canonical_code("v_aab*exp(v_aaa)", ("v_aaa", "v_aab")) == ("x0*exp(x1)", ("v_aab", "v_aaa"))
+    def run(bs):
+        a, b, c = rnd((bs, 24)), rnd((24, 10)), rnd((1, 10))
+        arr = (CLArray(a) @ CLArray(b)) + CLArray(c)
+        check_array(arr, a @ b + c, atol=1e-4)
+        check_array(arr.log_softmax().sum(axis=1), (a @ b + c - np.log(np.exp(a @ b + c).sum(1, keepdims=True))).sum(1), atol=1e-3)
+        check_array(CLArray(a).T @ CLArray(a), a.T @ a, atol=1e-3)
+    run(32)
+    programs = sum(cl.info["programs"].values())
+    # other batch sizes (e.g. the last partial batch) reuse the programs
+    for bs in (17, 5, 1, 100):
+        run(bs)
+    assert sum(cl.info["programs"].values()) == programs
+
+def test_matmul_tile_configs(monkeypatch):
+    import core.backend.opencl as clbackend
+    rnd = lambda s: np.random.randint(-5, 5, s).astype(np.float32)
+    # ragged sizes, K and N multiples of 4 (vectorized loads) and strided operands
+    shape_pairs = [[(1, 3), (3, 2)], [(7, 13), (13, 3)], [(33, 65), (65, 10)], [(64, 128), (128, 96)],
+                   [(3, 70, 9), (3, 9, 129)], [(2, 100, 36), (36, 40)]]
+    for name in clbackend.MATMUL_CONFIGS:
+        monkeypatch.setattr(clbackend, "matmul_config", lambda *_: name)
+        for s1, s2 in shape_pairs:
+            nparr1, nparr2 = rnd(s1), rnd(s2)
+            check_array(CLArray(nparr1) @ CLArray(nparr2), nparr1 @ nparr2)
+        nparr1, nparr2 = rnd((40, 24)), rnd((24, 36))
+        check_array(CLArray(nparr1.T.copy()).T @ CLArray(nparr2), nparr1 @ nparr2)
+        check_array(CLArray(nparr1)[3:30] @ CLArray(nparr2)[:, 4:], nparr1[3:30] @ nparr2[:, 4:], ignore=("stride",))
+
+def test_autotuner(tmp_path, monkeypatch):
+    import json
+    import core.backend.opencl as clbackend
+    path = str(tmp_path / "autotune.json")
+    monkeypatch.setattr(clbackend, "tuner", clbackend.Autotuner(path, enabled=True, repeat=1))
+    nparr1, nparr2 = rnd((70, 130)), rnd((130, 33))
+    arr1, arr2 = CLArray(nparr1), CLArray(nparr2)
+    check_array(arr1 @ arr2, nparr1 @ nparr2, atol=1e-4)
+    check_array(arr1.sum(axis=1), nparr1.sum(axis=1), atol=1e-4)
+    # the candidates of an in-place op run on a scratch output, the update is applied once
+    arr1 += arr1
+    check_array(arr1, nparr1 * 2)
+    with open(path) as f:
+        results = json.load(f)
+    ops = [k.split("|")[-2] for k in results]
+    assert all(op in ops for op in ("matmul_op", "reduce_op", "elemwise_op"))
+    assert all(v in clbackend.MATMUL_CONFIGS for k, v in results.items() if "matmul_op" in k)
+    # later runs reuse the persisted winners without tuning
+    tuner = clbackend.Autotuner(path, enabled=False)
+    monkeypatch.setattr(clbackend, "tuner", tuner)
+    check_array(arr1 @ arr2, (nparr1 * 2) @ nparr2, atol=1e-3)
+    assert tuner.results == results and ("matmul_op", tuner.shape_class(1, 70, 33, 130)) in tuner._memo
+    # the memo is keyed by shape class and an elemwise kernel resolves its params once per shape class
+    tuner = clbackend.Autotuner(path, enabled=False)
+    monkeypatch.setattr(clbackend, "tuner", tuner)
+    calls = []
+    monkeypatch.setattr(tuner, "choose", lambda *args: calls.append(args) or None)
+    for n in range(65, 128):
+        nparr = rnd((n,))
+        check_array(CLArray(nparr) * 2, nparr * 2)
+    assert len(calls) == len(tuner.kernel_params) <= 2 and len({c[:2] for c in calls}) == 1
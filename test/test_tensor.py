@@ -51,3 +51,31 @@ def test_comparison_operators():
         # comparison operator is not differentiable
         with pytest.raises(Exception):
             (a > b).backward()
+
+def test_optimizer_inplace_step():
+    import tracemalloc
+    from core.nn.optimizer import Adam, RMSProp, SGD
+    npw, npg = rnd((256, 256)), rnd((256, 256))
+    # reference adam
+    m, v, w = np.zeros_like(npw), np.zeros_like(npw), npw.copy()
+    for t in range(1, 4):
+        m += 0.1 * (npg - m)
+        v += 0.001 * (npg ** 2 - v)
+        w -= 1e-3 * (m / (1 - 0.9 ** t)) / ((v / (1 - 0.999 ** t)) ** 0.5 + 1e-8)
+    for device in ("gpu", "cpu"):
+        for optim_cls, kwargs in ((Adam, {}), (SGD, {"momentum": 0.9}), (RMSProp, {"momentum": 0.9})):
+            p = Tensor(npw, requires_grad=True).to(device)
+            p.grad = Tensor(npg).to(device).array
+            optim = optim_cls([{"w": p}], lr=1e-3, **kwargs)
+            optim.step()
+            array = p.array
+            if device == "cpu":
+                tracemalloc.start()
+            optim.step(); optim.step()
+            if device == "cpu":
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                # NOTE: no parameter sized temporaries after the states have been allocated
+                assert peak < npw.nbytes // 10 and p.array is array
+            if optim_cls is Adam:
+                check_tensor(p, w, atol=1e-5, rtol=1e-3)
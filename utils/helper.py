@@ -1,5 +1,3 @@
-import itertools
-import string
 import time
 from collections import defaultdict
 
@@ -11,18 +9,16 @@ def timer(func):
         return ret, cost
     return wrapper
 
-def genname(prefix, *args):
-    return f"{prefix}_" + "_".join(str(id(ts))[-4:] for ts in args)
+def genname(prefix, *ids):
+    return f"{prefix}_" + "_".join(str(i)[-4:] for i in ids)
 
 class VarNameGetter:
     def __init__(self):
-        letters = tuple(string.ascii_lowercase)
-        candidates = itertools.product(*([letters]*3))  # 26^4
-        self.candidates = tuple("v_" + "".join(s) for s in candidates)
         self.reset()
 
     def get(self):
-        name = self.candidates[self.idx]
+        # NOTE: unbounded, names of different lengths are substituted as whole words
+        name = f"v_{self.idx}"
         self.idx += 1
         return name
 